@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# Just enough of xscreensaver for the benchmarks to talk to, so they don't need the real thing (or a real screen) to run.
+#
+# Owns a _SCREENSAVER_VERSION window on every screen, keeps _SCREENSAVER_STATUS on the first screen's root window,
+# and answers SCREENSAVER ClientMessages by setting _SCREENSAVER_RESPONSE on the window they were sent to.
+# Prints "ready" once the windows exist so whatever started it knows when to start talking to it.
+#
+# NOTE: The responses are the ones xscreensaver's windows.c gives, as close as I can be bothered getting them.
+#       It never actually blanks anything, and DEACTIVATE unlocks straight away as if the password was typed instantly.
+
+import argparse
+import time
+
+import Xlib.X
+import Xlib.Xatom
+import Xlib.display
+
+VERSION = b"6.00"
+ATOM_NAMES = (
+    "SCREENSAVER", "_SCREENSAVER_VERSION", "_SCREENSAVER_RESPONSE", "_SCREENSAVER_ID", "_SCREENSAVER_STATUS",
+    "ACTIVATE", "DEACTIVATE", "CYCLE", "NEXT", "PREV", "SELECT", "EXIT", "RESTART", "DEMO", "PREFS", "LOCK", "THROTTLE",
+    "UNTHROTTLE", "BLANK",
+)
+
+
+class FakeXScreensaver():
+    def __init__(self, display_name: str = None):
+        self.display = Xlib.display.Display(display_name)
+        self.atoms = {name: self.display.intern_atom(name) for name in ATOM_NAMES}
+        self.state = 0  # 0, or the BLANK/LOCK atom, same as _SCREENSAVER_STATUS[0]
+        self.windows = []
+        self._create_windows()
+        self._set_status(0)
+
+    def _create_windows(self):
+        for screen_number in range(self.display.screen_count()):
+            screen = self.display.screen(screen_number)
+            window = screen.root.create_window(0, 0, 1, 1, 0, screen.root_depth, override_redirect=True)
+            window.change_property(self.atoms["_SCREENSAVER_VERSION"], Xlib.Xatom.STRING, 8, VERSION)
+            window.change_property(self.atoms["_SCREENSAVER_ID"], Xlib.Xatom.STRING, 8,
+                                   b"fake_xscreensaver.py")
+            self.windows.append(window)
+        self.display.flush()
+
+    def _set_status(self, state):
+        self.state = state
+        # [state, time of the last state change, then the hack running on each screen]
+        status = [state, int(time.time())] + [0] * len(self.windows)
+        self.display.screen(0).root.change_property(self.atoms["_SCREENSAVER_STATUS"], Xlib.Xatom.INTEGER, 32, status)
+
+    def _respond(self, window, response):
+        window.change_property(self.atoms["_SCREENSAVER_RESPONSE"], Xlib.Xatom.STRING, 8, response.encode() + b'\0')
+        self.display.flush()
+
+    def handle_command(self, command):
+        """Do whatever command means, returning the response xscreensaver would give"""
+        blank, lock = self.atoms["BLANK"], self.atoms["LOCK"]
+        if command == self.atoms["ACTIVATE"]:
+            if self.state:
+                return "+already active."
+            self._set_status(blank)
+            return "+activating."
+        elif command == self.atoms["DEACTIVATE"]:
+            if not self.state:
+                return "+not active: idle timer reset."
+            self._set_status(0)
+            return "+deactivating."
+        elif command == self.atoms["LOCK"]:
+            if self.state == lock:
+                return "+already locked."
+            response = "+locking." if self.state else "+activating and locking."
+            self._set_status(lock)
+            return response
+        elif command in (self.atoms["CYCLE"], self.atoms["NEXT"], self.atoms["PREV"], self.atoms["SELECT"]):
+            if not self.state:
+                self._set_status(blank)
+                return "+activating."
+            return "+cycling."
+        elif command == self.atoms["THROTTLE"]:
+            return "+throttled."
+        elif command == self.atoms["UNTHROTTLE"]:
+            return "+unthrottled."
+        elif command == self.atoms["DEMO"]:
+            return "+demo mode."
+        elif command == self.atoms["PREFS"]:
+            return "+preferences dialog."
+        elif command == self.atoms["EXIT"]:
+            return "+exiting."
+        elif command == self.atoms["RESTART"]:
+            return "+restarting."
+        return "-unrecognized command."
+
+    def run(self):
+        print("ready", flush=True)
+        while True:
+            ev = self.display.next_event()
+            if ev.type != Xlib.X.ClientMessage or ev.client_type != self.atoms["SCREENSAVER"]:
+                continue
+            format, data = ev.data
+            response = self.handle_command(data[0])
+            self._respond(ev.window, response)
+            if data[0] == self.atoms["EXIT"]:
+                return
+            elif data[0] == self.atoms["RESTART"]:
+                # A real restart gets new windows, which is exactly what clients need to cope with
+                for window in self.windows:
+                    window.destroy()
+                self.windows = []
+                self._create_windows()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pretend to be xscreensaver for benchmarking")
+    parser.add_argument('--display', default=None, help="X display to run on (default: $DISPLAY)")
+    args = parser.parse_args()
+
+    # When sent with an empty event mask, ClientMessages go to whoever created the window, so there's no need to select for them
+    FakeXScreensaver(args.display).run()
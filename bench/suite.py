@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# Offline benchmark suite for xscreensaver.py and dbus-xscreensaver.py.
+#
+# Starts its own Xvfb, fake_xscreensaver.py, and a private dbus-daemon so it never touches the real session,
+# then prints the results as JSON. Save a run and give it to --compare later to see what got faster or slower:
+#
+#     ./bench/suite.py --output before.json
+#     ./bench/suite.py --compare before.json
+#
+# Needs Xvfb and dbus-daemon installed, as well as everything dbus-xscreensaver.py needs.
+# NOTE: The daemon is run with --grace-period 0 so that every Inhibit takes effect straight away,
+#       which makes the churn figure the worst case rather than the usual Steam case.
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import dbus
+import dbus.bus
+import psutil
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+import xscreensaver  # noqa: E402
+
+BUS_NAME = "org.freedesktop.ScreenSaver"
+OBJECT_PATH = "/org/freedesktop/ScreenSaver"
+# How long to wait for each helper process to get going
+STARTUP_TIMEOUT = 10
+
+
+def percentiles(samples):
+    """Summarise a list of durations in seconds as milliseconds"""
+    samples = sorted(samples)
+
+    def pick(percent):
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))] * 1000
+
+    return {'p50': pick(50), 'p90': pick(90), 'p99': pick(99), 'max': samples[-1] * 1000, 'count': len(samples)}
+
+
+def timed(func, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def start_process(stack, args, **kwargs):
+    """Start a helper process that gets killed when stack closes"""
+    process = subprocess.Popen(args, **kwargs)
+
+    def stop():
+        process.terminate()
+        try:
+            process.wait(timeout=STARTUP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+    stack.callback(stop)
+    return process
+
+
+def start_xvfb(stack, screens: int):
+    read_fd, write_fd = os.pipe()
+    args = ['Xvfb', '-displayfd', str(write_fd), '-nolisten', 'tcp']
+    for screen_number in range(screens):
+        args += ['-screen', str(screen_number), '640x480x24']
+    start_process(stack, args, pass_fds=(write_fd,), stderr=subprocess.DEVNULL)
+    os.close(write_fd)
+    # Xvfb picks a free display number itself and writes it here once it's ready for clients
+    with os.fdopen(read_fd) as display_file:
+        display_number = display_file.readline().strip()
+    if not display_number:
+        raise RuntimeError("Xvfb failed to start")
+    return ':' + display_number
+
+
+def start_fake_xscreensaver(stack, display: str):
+    process = start_process(stack, [sys.executable, os.path.join(BENCH_DIR, 'fake_xscreensaver.py'), '--display', display],
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    if process.stdout.readline().strip() != 'ready':
+        raise RuntimeError("fake_xscreensaver.py failed to start")
+
+
+def start_dbus_daemon(stack):
+    process = start_process(stack, ['dbus-daemon', '--session', '--nofork', '--print-address'],
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    address = process.stdout.readline().strip()
+    if not address:
+        raise RuntimeError("dbus-daemon failed to start")
+    return address
+
+
+def start_screensaver_daemon(stack, bus, display: str, env: dict, xscreensaver_timeout: int):
+    process = start_process(stack, [sys.executable, os.path.join(REPO_DIR, 'dbus-xscreensaver.py'),
+                                    '--grace-period', '0',
+                                    '--xscreensaver-timeout', str(xscreensaver_timeout),
+                                    # Somewhere that doesn't exist, so the user's own rules can't skew anything
+                                    '--rules', os.path.join(env['XDG_RUNTIME_DIR'], 'rules.ini'),
+                                    '--display', display],
+                            env=env, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while not bus.name_has_owner(BUS_NAME):
+        if process.poll() is not None or time.monotonic() > deadline:
+            raise RuntimeError("dbus-xscreensaver.py failed to start")
+        time.sleep(0.05)
+    return process
+
+
+def bench_commands(display: str, iterations: int):
+    """Latency, X requests, and CPU time of each XSS_worker call"""
+    worker = xscreensaver.XSS_worker(display_names=[display])
+    protocol_display = worker.connections[0].display.display
+    results = {}
+    for command in ('activate', 'deactivate', 'lock', 'get_active'):
+        func = getattr(worker, command)
+        samples, requests = [], 0
+        cpu_start = time.process_time()
+        for _ in range(iterations):
+            serial = protocol_display.request_serial
+            start = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - start)
+            # The serial number is only 16 bits and wraps
+            requests += (protocol_display.request_serial - serial) % 65536
+        cpu = time.process_time() - cpu_start
+        results[command] = {
+            'latency_ms': percentiles(samples),
+            'x_requests': requests / iterations,
+            # Mostly spent waiting for xscreensaver's response, so this is how much that wait burns
+            'cpu_ms': cpu / iterations * 1000,
+        }
+        # Leave it unblanked for the next one
+        worker.deactivate()
+    return results
+
+
+def bench_dbus(screensaver, iterations: int, churn_seconds: float):
+    """Latency of the DBus methods, and how many Inhibit/UnInhibit pairs per second the daemon keeps up with"""
+    results = {
+        'GetActive': {'latency_ms': percentiles(timed(screensaver.GetActive, iterations))},
+        'SimulateUserActivity': {'latency_ms': percentiles(timed(screensaver.SimulateUserActivity, iterations))},
+    }
+
+    inhibit_samples, uninhibit_samples = [], []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        inhibitor_id = screensaver.Inhibit('bench', 'latency')
+        inhibit_samples.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        screensaver.UnInhibit(inhibitor_id)
+        uninhibit_samples.append(time.perf_counter() - start)
+    results['Inhibit'] = {'latency_ms': percentiles(inhibit_samples)}
+    results['UnInhibit'] = {'latency_ms': percentiles(uninhibit_samples)}
+
+    pairs = 0
+    deadline = time.perf_counter() + churn_seconds
+    while time.perf_counter() < deadline:
+        screensaver.UnInhibit(screensaver.Inhibit('bench', 'churn'))
+        pairs += 1
+    results['churn'] = {'pairs_per_second': pairs / churn_seconds}
+    return results
+
+
+def bench_idle_cpu(screensaver, daemon_pid: int, inhibitor_counts, idle_seconds: float):
+    """CPU time the daemon uses while idle with some number of inhibitors, scaled up to an hour"""
+    process = psutil.Process(daemon_pid)
+    results = {}
+    for count in inhibitor_counts:
+        # Different callers so they don't just get refcounted into 1 inhibitor
+        inhibitor_ids = [screensaver.Inhibit('bench {}'.format(n), 'idle') for n in range(count)]
+        before = process.cpu_times()
+        time.sleep(idle_seconds)
+        after = process.cpu_times()
+        cpu = (after.user - before.user) + (after.system - before.system)
+        results[str(count)] = {'cpu_seconds_per_hour': cpu * 3600 / idle_seconds}
+        for inhibitor_id in inhibitor_ids:
+            screensaver.UnInhibit(inhibitor_id)
+    return results
+
+
+def flatten(results, prefix=''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, prefix + key + '.')
+        elif isinstance(value, (int, float)):
+            yield prefix + key, value
+
+
+def compare(old, new):
+    """Print how every number in new changed since old"""
+    old_values = dict(flatten(old['results']))
+    print("Compared to {version} from {timestamp}:".format(**old['meta']), file=sys.stderr)
+    for key, value in flatten(new['results']):
+        if key not in old_values:
+            continue
+        change = (value - old_values[key]) / old_values[key] * 100 if old_values[key] else 0
+        print("    {key}: {old:.3f} -> {new:.3f} ({change:+.1f}%)".format(
+            key=key, old=old_values[key], new=value, change=change), file=sys.stderr)
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark xscreensaver.py and dbus-xscreensaver.py against a fake xscreensaver")
+    parser.add_argument('--iterations', type=int, default=200, help="Samples per latency measurement (default: %(default)s)")
+    parser.add_argument('--churn-seconds', type=float, default=5,
+                        help="How long to run Inhibit/UnInhibit churn for (default: %(default)s)")
+    parser.add_argument('--idle-seconds', type=float, default=60,
+                        help="How long to measure idle CPU for at each inhibitor count (default: %(default)s)")
+    parser.add_argument('--inhibitors', default='0,10,100',
+                        help="Comma separated inhibitor counts to measure idle CPU with (default: %(default)s)")
+    parser.add_argument('--xscreensaver-timeout', type=int, default=60,
+                        help="Timeout to tell the daemon xscreensaver has, at least 60 like xscreensaver itself (default: %(default)s)")
+    parser.add_argument('--screens', type=int, default=1, help="Number of screens for Xvfb to have (default: %(default)s)")
+    parser.add_argument('--display', default=None, help="Use this existing X server instead of starting Xvfb")
+    parser.add_argument('--output', default=None, help="Write the JSON results here instead of stdout")
+    parser.add_argument('--compare', default=None, help="Previous JSON results to compare against")
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        runtime_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix='xscreensaver-bench-'))
+        # Keeps the window ID cache out of the real $XDG_RUNTIME_DIR
+        os.environ['XDG_RUNTIME_DIR'] = runtime_dir
+        display = args.display or start_xvfb(stack, args.screens)
+        start_fake_xscreensaver(stack, display)
+        bus_address = start_dbus_daemon(stack)
+        env = dict(os.environ, DISPLAY=display, DBUS_SESSION_BUS_ADDRESS=bus_address)
+
+        results = {'commands': bench_commands(display, args.iterations)}
+
+        bus = dbus.bus.BusConnection(bus_address)
+        daemon = start_screensaver_daemon(stack, bus, display, env, args.xscreensaver_timeout)
+        screensaver = dbus.Interface(bus.get_object(BUS_NAME, OBJECT_PATH), BUS_NAME)
+        results['dbus'] = bench_dbus(screensaver, args.iterations, args.churn_seconds)
+        results['idle_cpu'] = bench_idle_cpu(screensaver, daemon.pid,
+                                             [int(count) for count in args.inhibitors.split(',')], args.idle_seconds)
+        bus.close()
+
+    output = {
+        'meta': {
+            'version': git_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'iterations': args.iterations,
+            'screens': args.screens,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as compare_file:
+            compare(json.load(compare_file), output)
+
+
+if __name__ == '__main__':
+    main()
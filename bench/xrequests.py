@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# Count how many X requests a single XSS_worker.deactivate() costs.
+#
+# Needs a running X server and xscreensaver on $DISPLAY.
+# The "uncached" figure replays the command path as it was before the protocol atoms were interned up front,
+# where every command re-interned SCREENSAVER, the command atom, and _SCREENSAVER_RESPONSE for each PropertyNotify.
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import xscreensaver  # noqa: E402
+
+
+def request_serial(worker):
+    # Only the one display, so the first connection is all of them
+    return worker.connections[0].display.display.request_serial
+
+
+def count_requests(worker, func):
+    start = request_serial(worker)
+    func()
+    # The serial number is only 16 bits and wraps
+    return (request_serial(worker) - start) % 65536
+
+
+def uncached_deactivate(worker):
+    """Send DEACTIVATE the way XSS_worker did before it had an atom table"""
+    connection = worker.connections[0]
+    real_atoms = connection.atoms
+
+    class InterningAtoms(dict):
+        def __getitem__(self, name):
+            return connection.display.intern_atom(name, False)
+
+    connection.atoms = InterningAtoms()
+    try:
+        return worker.deactivate()
+    finally:
+        connection.atoms = real_atoms
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count X requests per XSS_worker.deactivate()")
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    worker = xscreensaver.XSS_worker()
+    for label, func in (('uncached', lambda: uncached_deactivate(worker)),
+                        ('cached', worker.deactivate)):
+        counts = [count_requests(worker, func) for _ in range(args.iterations)]
+        print("{label}: {avg:.1f} X requests per deactivate() (min {min}, max {max})".format(
+            label=label, avg=sum(counts) / len(counts), min=min(counts), max=max(counts)))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,21 +6,34 @@
 # * org.freedesktop.ScreenSaver seemed a little more "standard" than org.gnome.ScreenSaver
 # * dbus-monitoring Chrome indicated it only targets org.freedesktop.ScreenSaver and that's the main thing I care about.
 
-# FIXME: Currently this only allows controlling xscreensaver, and maybe some status querying.
-#        It does NOT support telling DBus when Xscreensaver state updates
+# FIXME: Currently this only allows controlling xscreensaver, some status querying, and ActiveChanged signals.
 #
-#        I would like to improve this in future to implement xscreensaver-command's -watch functionality
-#        and emit DBus messages accordingly
-#        NOTE: xscreensaver-command.c did this with what looks like simply a "while true: GetActiveTime()" loop.
+# NOTE: xscreensaver-command.c implemented -watch with what looks like simply a "while true: GetActiveTime()" loop.
+#       Instead this listens for PropertyNotify events on the root window's _SCREENSAVER_STATUS from the GLib main loop,
+#       so it's not waking up at all unless xscreensaver's state actually changes.
 
-# FIXME: Facebook's gifs are played using the <video> element, which causes Chrome to repeatedly inhibit the screensaver.
-#        Only solution I can think of for this would be to just not start the inhibitor process until 30-ish seconds after Chrome triggers it.
-#        This is an ugly solution, but I can't think of any better.
+# NOTE: Facebook's gifs are played using the <video> element, which causes Chrome to repeatedly inhibit the screensaver.
+#       Only solution I can think of for this would be to just not start the inhibitor process until 30-ish seconds after Chrome triggers it.
+#       This is an ugly solution, but I can't think of any better.
+#       Inhibitors don't take effect until a short grace period has passed, and a rules file can make that longer for specific apps.
 
-import random
+import argparse
+import bisect
+import collections
+import configparser
+import contextlib
+import functools
+import heapq
+import json
+import logging
+import logging.handlers
+import os
+import re
+import signal
 import sys
 import time
-import psutil
+# NOTE: psutil and socket are only imported when they're first needed,
+#       this gets started by DBus activation when something first calls Inhibit so startup time matters.
 
 # FIXME: Can gi.repository.DBus get the same functionality?
 #        Should I use that to reduce dependencies?
@@ -29,139 +42,955 @@ import dbus.service
 import dbus.mainloop.glib
 from gi.repository import GLib
 
-# FIXME: Xlib is obsolete and should be replaced.
-#        I guess technically it'd be replaced by DBus,
-#        so maybe it's completely valid for me to use it here as a compatibility layer
-import Xlib.Xatom
-import Xlib.display
-import Xlib.protocol
+# The xscreensaver side of things (the protocol, finding its windows, combining multiple displays) lives in xscreensaver.py next to this,
+# this just drives it from the GLib main loop instead of blocking.
+import xscreensaver
+from xscreensaver import NoScreensaverError, XSSTimeoutError
 
+# Inhibitor IDs get returned as a DBus UInt32, and 0 is never used so it's obvious when something's gone wrong
+MAX_INHIBITOR_ID = 2**32 - 1
 
-# FIXME: Turn this into its own "xscreensaver_command" library and import that.
-class XSS_worker():
-    timeout_source_id = None
+# Extra methods for inspecting the daemon itself that aren't part of org.freedesktop.ScreenSaver
+INSPECT_INTERFACE = "com.github.mijofa.XScreensaver"
+
+# xscreensaver won't let the timeout go below 1 minute, so that's the safe assumption if we can't find the real timeout
+MIN_XSCREENSAVER_TIMEOUT = 60
+# How long before xscreensaver would blank to poke it
+POKE_MARGIN = 10
+# Never check the inhibitors more often than this, whatever the maths says
+MIN_POKE_DELAY = 1
+# How soon to try again when xscreensaver didn't take a poke
+POKE_RETRY_DELAY = 5
+
+# Histogram buckets, in seconds unless the name says otherwise
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+HISTOGRAM_BUCKETS = {
+    'xscreensaver_command_x_requests': (1, 2, 3, 4, 6, 8, 16, 32),
+    'xscreensaver_inhibitor_lifetime_seconds': (1, 5, 10, 30, 60, 300, 900, 3600, 4 * 3600, 12 * 3600),
+}
+# Caller names come straight from DBus clients, so only this many get their own metrics label before the rest get lumped together
+MAX_CALLER_LABELS = 100
+
+logger = logging.getLogger('dbus-xscreensaver')
+# Fields that log calls pass with extra=, in the order they get written out
+LOG_FIELDS = ('inhibitor_id', 'caller', 'reason', 'process_name', 'pid', 'dbus_sender', 'command', 'display')
+
+DEFAULT_RULES_PATH = os.path.join(os.environ.get('XDG_CONFIG_HOME', os.path.expanduser('~/.config')),
+                                  'dbus-xscreensaver', 'rules.ini')
+DEFAULT_STATE_PATH = os.path.join(os.environ['XDG_RUNTIME_DIR'], 'dbus-xscreensaver.state') \
+    if os.environ.get('XDG_RUNTIME_DIR') else None
+
+
+def read_xscreensaver_timeout(path: str = os.path.expanduser('~/.xscreensaver')):
+    """Get xscreensaver's blank timeout in seconds from its config file, or None if it's not set there"""
+    try:
+        with open(path) as config:
+            for line in config:
+                key, sep, value = line.partition(':')
+                if sep and key.strip() == 'timeout':
+                    value = value.strip()
+                    if ':' in value:
+                        # H:MM:SS
+                        hours, minutes, seconds = (int(i) for i in value.split(':'))
+                        return hours * 3600 + minutes * 60 + seconds
+                    else:
+                        # Very old versions just used minutes
+                        return int(value) * 60
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class Inhibitor():
+    __slots__ = ('inhibitor_id', 'caller', 'reason', 'dbus_sender', 'pid', 'process_name', 'created', 'armed', 'refcount')
+
+    def __init__(self, inhibitor_id: int, caller: str, reason: str, dbus_sender: str, pid: int, process_name: str = None):
+        self.inhibitor_id = inhibitor_id
+        self.caller = caller
+        self.reason = reason
+        self.dbus_sender = dbus_sender
+        self.pid = pid
+        self.process_name = process_name
+        self.created = time.time()
+        # Inhibitors don't actually do anything until their grace period is over
+        self.armed = False
+        # How many times this same caller asked for this same inhibitor without uninhibiting
+        self.refcount = 1
 
+    def log_fields(self):
+        """Everything worth knowing about this inhibitor, for a log call's extra="""
+        return {'inhibitor_id': self.inhibitor_id, 'caller': self.caller, 'reason': self.reason,
+                'process_name': self.process_name, 'pid': self.pid, 'dbus_sender': self.dbus_sender}
+
+    def __repr__(self):
+        return '<Inhibitor {inhibitor_id} for "{caller}" ({process_name}, {dbus_sender})>'.format(
+            inhibitor_id=self.inhibitor_id, caller=self.caller, process_name=self.process_name, dbus_sender=self.dbus_sender)
+
+
+class InhibitorRegistry():
+    """The current inhibitors, indexed by ID as well as by DBus sender, PID, and application (caller) name"""
     def __init__(self):
-        self.inhibitors = {}  # Must be set in the __init__ function because of list immutability
-
-        self.display = Xlib.display.Display()
-
-        ## Find the xscreensaver window.
-        screensavers = [child for child in self.display.screen().root.query_tree().children
-                        if child.get_full_property(self.display.intern_atom("_SCREENSAVER_VERSION", False), Xlib.Xatom.STRING)]
-        # FIXME: Use actual exceptions
-        ## Actually we can have multiple screensaver windows because there's 1 for each output display.
-        ## xscreensaver-command stops at the first one it finds, so we'll do the same.
-        # assert not len(screensavers) > 1, "Can't have multiple screensaver windows!"
-        assert not len(screensavers) < 1, "No screensaver window found. Is there a screensaver running?"
-        # Don't actually want a list, it was just the easiest way to loop over the query_tree and assert only 1 window
-        self.xss_window = screensavers[0]
-
-        ## Set the event_mask se that responses can be caught
-        self.xss_window.change_attributes(event_mask=Xlib.X.PropertyChangeMask)
-
-    def _get_xscreensaver_response(self):
-        # NOTE: I've already set the necessary event mask for the xscreensaver window object to include Xlib.X.PropertyChangeMask
-        response = None  # So the assert below actually triggers rather than a UnboundLocalError
-        timeout = time.monotonic() + 1
-        while time.monotonic() < timeout:  # If there hasn't been a response in 1 second, there won't be one
-            if self.display.pending_events():
-                ev = self.display.next_event()
-                if ev.type == Xlib.X.PropertyNotify and \
-                   ev.state == Xlib.X.PropertyNewValue and \
-                   ev.atom == self.display.intern_atom("_SCREENSAVER_RESPONSE", False):
-                        # NOTE: The C code accepts AnyPropertyType, not just Strings, I'm being more defensive here.
-                        # FIXME: Can there be multiple responses all at once? Should we wait the whole second and add them all up?
-                        # FIXME: Can I just get the property info from the event object?
-                        response = ev.window.get_full_property(
-                            self.display.intern_atom("_SCREENSAVER_RESPONSE", False),
-                            Xlib.Xatom.STRING)
-                        break
-        assert response, "No response recieved"
-        return response.value
-
-    def get_active(self):
-        status = self.display.screen().root.get_full_property(
-            self.display.intern_atom("_SCREENSAVER_STATUS", False), Xlib.Xatom.INTEGER).value
-        blanked = status[0]
-        # tt = status[1]  # Something to do with the time since blanked/unblanked, not implemented here yet
-        if blanked in (self.display.intern_atom("BLANK", False), self.display.intern_atom("LOCK", False)):
+        self._inhibitors = {}
+        # {key: {inhibitor_id, ...}}
+        self.by_sender = {}
+        self.by_pid = {}
+        self.by_caller = {}
+        self._next_id = 1
+
+    def __len__(self):
+        return len(self._inhibitors)
+
+    def __contains__(self, inhibitor_id):
+        return inhibitor_id in self._inhibitors
+
+    def __getitem__(self, inhibitor_id):
+        return self._inhibitors[inhibitor_id]
+
+    def __iter__(self):
+        return iter(self._inhibitors.values())
+
+    def allocate_id(self):
+        # Count upwards and wrap around, skipping anything still in use.
+        # Unlike random IDs this can't hand out duplicates, and it doesn't reuse an ID soon after it was freed.
+        if len(self._inhibitors) >= MAX_INHIBITOR_ID:
+            raise OverflowError("Ran out of inhibitor IDs")
+        while True:
+            inhibitor_id = self._next_id
+            self._next_id = self._next_id % MAX_INHIBITOR_ID + 1
+            if inhibitor_id not in self._inhibitors:
+                return inhibitor_id
+
+    def add(self, caller: str, reason: str, dbus_sender: str, pid: int, process_name: str = None, inhibitor_id: int = None):
+        if inhibitor_id is None:
+            inhibitor_id = self.allocate_id()
+        inhibitor = Inhibitor(inhibitor_id, caller, reason, dbus_sender, pid, process_name)
+        self._inhibitors[inhibitor.inhibitor_id] = inhibitor
+        self.by_sender.setdefault(dbus_sender, set()).add(inhibitor.inhibitor_id)
+        self.by_pid.setdefault(pid, set()).add(inhibitor.inhibitor_id)
+        self.by_caller.setdefault(caller, set()).add(inhibitor.inhibitor_id)
+        return inhibitor
+
+    def remove(self, inhibitor_id: int):
+        inhibitor = self._inhibitors.pop(inhibitor_id)
+        for index, key in ((self.by_sender, inhibitor.dbus_sender),
+                           (self.by_pid, inhibitor.pid),
+                           (self.by_caller, inhibitor.caller)):
+            index[key].discard(inhibitor_id)
+            if not index[key]:
+                del index[key]
+        return inhibitor
+
+    def lookup(self, index: dict, key):
+        """All the inhibitors in index (by_sender, by_pid, or by_caller) for key"""
+        return [self._inhibitors[inhibitor_id] for inhibitor_id in index.get(key, ())]
+
+    def snapshot(self):
+        """Everything restore() needs to recreate these inhibitors, in a form json can cope with"""
+        # Lists rather than dicts to keep the file small, see restore() for the order
+        return {'next_id': self._next_id,
+                'inhibitors': [[i.inhibitor_id, i.caller, i.reason, i.dbus_sender, i.pid, i.created, i.refcount, i.armed]
+                               for i in self]}
+
+    def restore(self, snapshot: dict, keep):
+        """Re-add the inhibitors from a snapshot() that keep(dbus_sender, pid) is True for, returning [(inhibitor, was armed)]"""
+        # Carry on from the same ID so that nobody's old ID can end up pointing at someone else's new inhibitor
+        self._next_id = min(max(int(snapshot['next_id']), 1), MAX_INHIBITOR_ID)
+        restored = []
+        for inhibitor_id, caller, reason, dbus_sender, pid, created, refcount, armed in snapshot['inhibitors']:
+            if inhibitor_id in self._inhibitors or not keep(dbus_sender, pid):
+                continue
+            inhibitor = self.add(caller, reason, dbus_sender, pid, inhibitor_id=inhibitor_id)
+            inhibitor.created = created
+            inhibitor.refcount = refcount
+            restored.append((inhibitor, armed))
+        return restored
+
+
+class InhibitRule():
+    """
+    A single section of the rules file, for example:
+
+        [steam]
+        caller = My SDL application
+        reason = Playing a game
+        action = ignore
+
+    caller & reason are regular expressions that must match the whole string, leaving either out matches anything.
+    action is one of:
+        ignore:    Pretend to inhibit, but don't
+        delay:     Wait 'delay' seconds (instead of the usual grace period) before the inhibitor takes effect
+        ratelimit: Ignore the inhibitor if that caller has already inhibited 'limit' times in the last 'period' seconds
+    """
+    __slots__ = ('name', 'caller', 'reason', 'action', 'delay', 'limit', 'period', '_recent')
+
+    def __init__(self, name: str, section: configparser.SectionProxy):
+        self.name = name
+        # Compile everything now, matching happens on every Inhibit call
+        self.caller = re.compile(section['caller']) if 'caller' in section else None
+        self.reason = re.compile(section['reason']) if 'reason' in section else None
+        self.action = section.get('action', 'ignore')
+        if self.action not in ('ignore', 'delay', 'ratelimit'):
+            raise ValueError("Unknown action {action!r} in rule [{name}]".format(action=self.action, name=name))
+        self.delay = section.getfloat('delay', 0)
+        self.limit = section.getint('limit', 1)
+        self.period = section.getfloat('period', 60)
+        if self.limit < 1:
+            raise ValueError("limit must be at least 1 in rule [{name}], use action = ignore instead".format(name=name))
+        if self.period <= 0:
+            raise ValueError("period must be more than 0 in rule [{name}]".format(name=name))
+        self._recent = {}  # {caller: deque of recent Inhibit times}
+
+    def matches(self, caller: str, reason: str):
+        return (self.caller is None or self.caller.fullmatch(caller)) and \
+               (self.reason is None or self.reason.fullmatch(reason))
+
+    def rate_limited(self, caller: str):
+        """Record an Inhibit from caller, returning True if it's over the limit"""
+        now = time.monotonic()
+        recent = self._recent.setdefault(caller, collections.deque(maxlen=self.limit))
+        if len(recent) == self.limit and now - recent[0] < self.period:
             return True
+        recent.append(now)
+        return False
+
+
+class InhibitRules():
+    """Per-application rules for ignoring, delaying, or rate-limiting inhibitors, first match wins"""
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+
+    @classmethod
+    def load(cls, path: str):
+        config = configparser.ConfigParser(interpolation=None)
+        with open(path) as rules_file:
+            config.read_file(rules_file)
+        return cls(InhibitRule(name, config[name]) for name in config.sections())
+
+    def match(self, caller: str, reason: str):
+        for rule in self.rules:
+            if rule.matches(caller, reason):
+                return rule
+        return None
+
+
+class Histogram():
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is everything bigger than the biggest bucket
+        self.sum = 0
+
+    def observe(self, value):
+        # Prometheus buckets are "less than or equal to", which is exactly what bisect_left finds
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+def _format_series(name, labels):
+    if not labels:
+        return name
+    return '{name}{{{labels}}}'.format(name=name, labels=','.join(
+        '{key}="{value}"'.format(key=key, value=str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels))
+
+
+class Metrics():
+    """Counters, gauges, and histograms about the daemon, for GetStats and --metrics-socket"""
+    def __init__(self):
+        # All keyed by (name, ((label, value), ...)) so they're cheap to bump from hot paths
+        self.counters = collections.Counter()
+        self.histograms = {}
+        # {name: function returning the current value}, these only get worked out when someone asks
+        self.gauges = {}
+        self._callers = set()
+
+    def inc(self, name, amount=1, **labels):
+        self.counters[name, tuple(sorted(labels.items()))] += amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS))
+        histogram.observe(value)
+
+    def caller_label(self, caller: str):
+        if caller not in self._callers:
+            if len(self._callers) >= MAX_CALLER_LABELS:
+                return '<other>'
+            self._callers.add(caller)
+        return caller
+
+    def samples(self):
+        """Yield (type, metric name, series name, labels, value) for every current value, histograms become several series"""
+        for name, func in self.gauges.items():
+            yield 'gauge', name, name, (), func()
+        for (name, labels), value in self.counters.items():
+            yield 'counter', name, name, labels, value
+        for (name, labels), histogram in self.histograms.items():
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else '{:g}'.format(bound)
+                yield 'histogram', name, name + '_bucket', labels + (('le', le),), cumulative
+            yield 'histogram', name, name + '_sum', labels, histogram.sum
+            yield 'histogram', name, name + '_count', labels, cumulative
+
+    def as_dict(self):
+        return {_format_series(series, labels): value for metric_type, name, series, labels, value in self.samples()}
+
+    def prometheus_text(self):
+        lines = []
+        typed = set()
+        for metric_type, name, series, labels, value in self.samples():
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {name} {metric_type}'.format(name=name, metric_type=metric_type))
+            lines.append('{series} {value}'.format(series=_format_series(series, labels), value=value))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsSocket():
+    """Unix socket that writes Metrics.prometheus_text() to anyone that connects, eg. socat - UNIX-CONNECT:path"""
+    def __init__(self, path: str, metrics: Metrics):
+        import socket
+        self.metrics = metrics
+        # Probably left over from the last time this ran
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        os.chmod(path, 0o600)
+        self.socket.listen()
+        self.socket.setblocking(False)
+        GLib.io_add_watch(self.socket.fileno(), GLib.PRIORITY_LOW, GLib.IO_IN, self._accept)
+
+    def _accept(self, *args):
+        try:
+            connection, address = self.socket.accept()
+        except BlockingIOError:
+            return GLib.SOURCE_CONTINUE
+        with connection:
+            # A stuck client can only hold up the main loop this long
+            connection.settimeout(1)
+            try:
+                connection.sendall(self.metrics.prometheus_text().encode())
+            except OSError as e:
+                logger.debug("Couldn't send metrics: %s", e)
+        return GLib.SOURCE_CONTINUE
+
+
+class MainLoopLogHandler(logging.handlers.BufferingHandler):
+    """
+    Hold log records until the main loop is idle, then write them all out at once.
+    That way a burst of Inhibit calls costs 1 write instead of a flushed write per line.
+    """
+    def __init__(self, stream=sys.stderr, capacity: int = 1000):
+        super().__init__(capacity)
+        self.stream = stream
+        self._flush_source_id = None
+
+    def shouldFlush(self, record):
+        # Warnings and errors might be followed by a crash, so don't hold on to them
+        return len(self.buffer) >= self.capacity or record.levelno >= logging.WARNING
+
+    def emit(self, record):
+        super().emit(record)
+        if self.buffer and self._flush_source_id is None:
+            self._flush_source_id = GLib.idle_add(self._idle_flush, priority=GLib.PRIORITY_LOW)
+
+    def _idle_flush(self):
+        self._flush_source_id = None
+        self.flush()
+        return GLib.SOURCE_REMOVE
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                self.stream.write(''.join(self.format(record) + '\n' for record in self.buffer))
+                self.stream.flush()
+                self.buffer.clear()
+        finally:
+            self.release()
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Append any LOG_FIELDS the record has as key=value pairs, for grepping the journal by inhibitor or caller"""
+    def format(self, record):
+        message = super().format(record)
+        for key in LOG_FIELDS:
+            value = getattr(record, key, None)
+            if value is None:
+                continue
+            value = str(value)
+            # Callers and reasons come from DBus clients and often have spaces in them
+            if not value or any(c in value for c in ' "=\n\\'):
+                value = json.dumps(value)
+            message += ' {key}={value}'.format(key=key, value=value)
+        return message
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, with the LOG_FIELDS as their own keys"""
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname, 'message': record.getMessage()}
+        for key in LOG_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class XSS_connection(xscreensaver.XSS_connection):
+    """
+    xscreensaver.XSS_connection driven from the GLib main loop instead of blocking.
+    Commands queue up and get sent 1 at a time, and the status is read as soon as it changes rather than when asked for.
+    """
+    def __init__(self, display_name: str = None, response_timeout: float = 1, metrics: Metrics = None):
+        super().__init__(display_name)
+        # If there hasn't been a response in 1 second, there won't be one
+        self.response_timeout = response_timeout
+        self.metrics = metrics or Metrics()
+        self.status_callbacks = []
+
+        # xscreensaver only has the one _SCREENSAVER_RESPONSE property to reply with,
+        # so only one command can be in flight at a time and the rest wait here.
+        self._command_queue = collections.deque()
+        self._command_in_flight = None
+        self._command_timeout_id = None
+        # (time.monotonic(), X request serial) from when the in-flight command was sent, for the metrics
+        self._command_started = None
+
+        # Keep track of xscreensaver's state so nothing needs to ask the X server for it,
+        # not the inhibitors before every poke nor DBus clients polling GetActive.
+        # The parent already selected PropertyNotify on status_root, so a change after this read can't get missed.
+        self.status = self._read_status()
+
+        # Everything coming from the X server gets dealt with from the GLib main loop as it arrives
+        GLib.io_add_watch(self.display.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._process_events)
+
+    def _response_arrived(self, response: str):
+        if self._command_in_flight is None:
+            # Probably a late response to a command that already timed out
+            return
+        self._finish_command(response)
+
+    def _status_notify(self):
+        # NOTE: This runs from the IO watch, _read_status() copes with the property going missing rather than raising,
+        #       which would remove the watch and stop all event handling.
+        last_status = self.status
+        status = self._read_status()
+        # _SCREENSAVER_STATUS also changes when xscreensaver switches to another hack, ignore those
+        if status[0] == last_status[0]:
+            self.status = last_status
+            return
+        for callback in self.status_callbacks:
+            callback(*status)
+
+    def _process_events(self, *args):
+        """Handle everything that's waiting in the X connection, usable as a GLib IO watch callback"""
+        super()._process_events()
+
+        if self._command_in_flight is not None and self._command_in_flight[3].get_error():
+            # The xscreensaver window went away before it got the command.
+            # Try the next window, or find the new ones and try once more, otherwise give up on this command.
+            atom_name, handlers, attempt, bad_window, window = self._command_in_flight
+            self._forget_window(window.id)
+            if attempt < 1:
+                self._cancel_command_timeout()
+                self._command_in_flight = None
+                self._command_queue.appendleft([atom_name, handlers, attempt + 1])
+                self._send_next_command()
+            else:
+                self._finish_command(error=NoScreensaverError(
+                    "xscreensaver window keeps disappearing on {display}. Is xscreensaver restarting?".format(
+                        display=self.display.get_display_name())))
+        return GLib.SOURCE_CONTINUE
+
+    def _finish_idle_time(self, request):
+        idle = super()._finish_idle_time(request)
+        if request is not None:
+            # Xlib might have read events off the socket while waiting for the reply,
+            # the IO watch won't trigger for those since they're no longer waiting on the socket.
+            self._process_events()
+        return idle
+
+    def queue_command(self, atom_name, reply_handler=None, error_handler=None):
+        """
+        Send a command to xscreensaver on this display without blocking the main loop.
+        reply_handler(response) gets called with xscreensaver's response,
+        or error_handler(exception) if there was no response.
+        """
+        # If the same command is the last one waiting to be sent there's no point sending it twice,
+        # just give both callers the same response.
+        # NOTE: Only the last one, merging with anything earlier would reorder it past whatever was queued in between.
+        if self._command_queue and self._command_queue[-1][0] == atom_name:
+            self._command_queue[-1][1].append((reply_handler, error_handler))
         else:
-            return False
+            self._command_queue.append([atom_name, [(reply_handler, error_handler)], 0])
+
+        if self._command_in_flight is None:
+            self._send_next_command()
+
+    def _send_next_command(self):
+        while self._command_queue and self._command_in_flight is None:
+            atom_name, handlers, attempt = self._command_queue.popleft()
+            if not self.xss_windows:
+                try:
+                    self._find_xss_windows()
+                except NoScreensaverError as e:
+                    self._command_in_flight = (atom_name, handlers, attempt, None, None)
+                    self._finish_command(error=e)
+                    continue
+
+            self._command_started = (time.monotonic(), self.display.display.request_serial)
+            bad_window = self._start_command(atom_name)
+            self._command_in_flight = (atom_name, handlers, attempt, bad_window, self._command_window)
+            # If there hasn't been a response by then, there won't be one
+            self._command_timeout_id = GLib.timeout_add(int(self.response_timeout * 1000), self._command_timed_out)
+
+    def _cancel_command_timeout(self):
+        if self._command_timeout_id is not None:
+            GLib.source_remove(self._command_timeout_id)
+            self._command_timeout_id = None
+
+    def _command_timed_out(self):
+        self._command_timeout_id = None
+        self._finish_command(error=XSSTimeoutError("No response received from xscreensaver on {display}".format(
+            display=self.display.get_display_name())))
+        return GLib.SOURCE_REMOVE
 
-    def send_command(self, atom_name):
-        Xevent = Xlib.protocol.event.ClientMessage(
-            display=self.display,
-            window=self.xss_window,
-            client_type=self.display.intern_atom("SCREENSAVER", False),
-            # In the C code the last [0, 0] happened implicitly, Python's xlib doesn't cope well with them being left out though.
-            # The first [0, 0] was set according to certain other arguments, but for DEACTIVATE was always [0, 0]
-            data=(32, [self.display.intern_atom(atom_name, False), 0, 0, 0, 0]),
-        )
-        self.display.send_event(destination=Xevent.window,
-                                propagate=False,
-                                event_mask=0,
-                                event=Xevent,
-                                # FIXME: Should raise an exception here
-                                onerror=lambda err: print('ERROR:', err, file=sys.stderr, flush=True))
-
-        return self._get_xscreensaver_response()
-
-    def add_inhibitor(self, inhibitor_id: int, caller: dbus.String, reason: dbus.String, caller_process: psutil.Process):
-        assert inhibitor_id not in self.inhibitors, "Already working on that inhibitor"
-        self.inhibitors.update({inhibitor_id: {'caller': caller, 'reason': reason, 'caller_process': caller_process}})
-        print('Inhibitor requested by "{caller}" ({process_name}) for reason "{reason}". Given ID {ID}'.format(
-                  caller=caller, reason=reason, ID=inhibitor_id, process_name=caller_process.name()),  # noqa: E126
-              file=sys.stderr, flush=True)
+    def _finish_command(self, response=None, error=None):
+        """Hand the response (or error) for the in-flight command to its callers, then send the next command"""
+        self._cancel_command_timeout()
+        atom_name, handlers, attempt, bad_window, window = self._command_in_flight
+        self._command_in_flight = None
+        if error is not None:
+            self.metrics.inc('xscreensaver_command_errors_total', command=atom_name, error=type(error).__name__)
+            logger.debug("Command failed: %s", error, extra={'command': atom_name, 'display': self.display.get_display_name()})
+        elif self._command_started is not None:
+            started, serial = self._command_started
+            self.metrics.observe('xscreensaver_command_response_seconds', time.monotonic() - started, command=atom_name)
+            # NOTE: This also counts anything else that got sent while waiting, like GetSessionIdleTime's query.
+            #       The serial number is only 16 bits and wraps.
+            self.metrics.observe('xscreensaver_command_x_requests', (self.display.display.request_serial - serial) % 65536,
+                                 command=atom_name)
+        self._command_started = None
+        for reply_handler, error_handler in handlers:
+            if error is None and reply_handler is not None:
+                reply_handler(response)
+            elif error is not None and error_handler is not None:
+                error_handler(error)
+        self._send_next_command()
+
+
+class XSS_worker(xscreensaver.XSS_pool):
+    """xscreensaver.XSS_pool driven from the GLib main loop, plus the inhibitors that keep poking it"""
+    timeout_source_id = None
+    connection_class = XSS_connection
+
+    def __init__(self, response_timeout: float = 1, grace_period: float = 5, rules: InhibitRules = None,
+                 xscreensaver_timeout: int = None, display_names=(None,), idle_timeout: float = 0, state_path: str = None):
+        self.inhibitors = InhibitorRegistry()  # Must be set in the __init__ function because of list immutability
+        # Because of Steam (at least) being stupid and constantly Inhibitting then UnInhibiting,
+        # inhibitors don't take effect until they've been around for this long.
+        # That way the Inhibit/UnInhibit pairs never even get as far as touching the poke timer.
+        self.grace_period = grace_period
+        self.rules = rules or InhibitRules()
+        self._pending_inhibitors = []  # heapq of (arm time, inhibitor ID)
+        self._arm_source_id = None
+        self._armed_count = 0
+        # If this is None, it gets read from ~/.xscreensaver every time it changes
+        self.xscreensaver_timeout = xscreensaver_timeout
+        self._xscreensaver_config_mtime = -1
+        self._config_timeout = MIN_XSCREENSAVER_TIMEOUT
+        self._last_poke = None
+        # With no inhibitors for this many seconds, call the idle_callbacks so the daemon can exit. 0 means never.
+        # DBus activation will start it again when something next wants it.
+        self.idle_timeout = idle_timeout
+        self.idle_callbacks = []
+        self._idle_source_id = None
+        # Where to keep a copy of the inhibitors so they survive a restart, see save_state()
+        self.state_path = state_path
+        self._save_source_id = None
+
+        self.metrics = Metrics()
+        self.metrics.gauges.update({
+            'xscreensaver_inhibitors': lambda: len(self.inhibitors),
+            'xscreensaver_inhibitors_armed': lambda: self._armed_count,
+            'xscreensaver_queued_commands': lambda: sum(len(c._command_queue) for c in self.connections),
+        })
+
+        # One connection per X display, each with its own xscreensaver.
+        # Commands go to all of them, and the status is whichever display is the most blanked.
+        super().__init__(display_names, response_timeout=response_timeout, metrics=self.metrics)
+        self.status_callbacks = []
+        for connection in self.connections:
+            connection.status_callbacks.append(self._connection_status_changed)
+        self.status = self._aggregate_status()
+        self._update_idle_timer()
+
+    def _aggregate_status(self):
+        return self._most_blanked(connection.status for connection in self.connections)
+
+    def _connection_status_changed(self, state, since):
+        status = self._aggregate_status()
+        # One display blanking while another already is doesn't change anything as far as anyone else can tell
+        if status[0] != self.status[0]:
+            self.status = status
+            for callback in self.status_callbacks:
+                callback(*status)
+
+    def watch(self, callback):
+        """
+        Call callback(state, timestamp), like get_status() returns, every time xscreensaver blanks, locks, or unblanks.
+        This is the equivalent of xscreensaver-command -watch, except that it sleeps on the X connections between changes.
+        """
+        self.status_callbacks.append(callback)
+
+    def get_status(self):
+        # NOTE: This is kept up to date by the PropertyNotify events, so it never needs to ask the X server
+        return self.status
+
+    def queue_command(self, atom_name, reply_handler=None, error_handler=None):
+        """
+        Send a command to xscreensaver on every display without blocking the main loop.
+        reply_handler(responses) gets called with a list of xscreensaver's responses, one per display,
+        or error_handler(exception) if any display didn't respond.
+        """
+        # Every display gets sent the command straight away, the callers only hear back once they've all answered.
+        pending = {'responses': [None] * len(self.connections), 'waiting': len(self.connections), 'error': None}
+
+        def finished(index, response=None, error=None):
+            pending['responses'][index] = response
+            pending['error'] = pending['error'] or error
+            pending['waiting'] -= 1
+            if pending['waiting'] > 0:
+                return
+            if pending['error'] is None and reply_handler is not None:
+                reply_handler(pending['responses'])
+            elif pending['error'] is not None and error_handler is not None:
+                error_handler(pending['error'])
+
+        for index, connection in enumerate(self.connections):
+            connection.queue_command(atom_name, functools.partial(finished, index),
+                                     functools.partial(lambda index, error: finished(index, error=error), index))
+
+    def add_inhibitor(self, caller: dbus.String, reason: dbus.String, dbus_sender: str, pid: int):
+        caller, reason = str(caller), str(reason)
+        self.metrics.inc('xscreensaver_inhibits_total', caller=self.metrics.caller_label(caller))
+        delay = self.grace_period
+        rule = self.rules.match(caller, reason)
+        if rule is not None:
+            self.metrics.inc('xscreensaver_inhibit_rule_matches_total', rule=rule.name, action=rule.action)
+            if rule.action == 'ignore' or (rule.action == 'ratelimit' and rule.rate_limited(caller)):
+                # Still need to give them an ID, UnInhibit will just ignore it later.
+                return self.inhibitors.allocate_id()
+            elif rule.action == 'delay':
+                delay = rule.delay
+
+        # Chrome especially will ask for the same thing over and over, just count them rather than making a new inhibitor each time
+        for inhibitor in self.inhibitors.lookup(self.inhibitors.by_sender, dbus_sender):
+            if inhibitor.caller == caller and inhibitor.reason == reason:
+                self.metrics.inc('xscreensaver_inhibits_refcounted_total')
+                inhibitor.refcount += 1
+                self._inhibitors_changed()
+                return inhibitor.inhibitor_id
+
+        inhibitor = self.inhibitors.add(caller=caller, reason=reason, dbus_sender=dbus_sender, pid=pid)
+        self._inhibitors_changed()
+        if delay <= 0:
+            self._arm_inhibitor(inhibitor)
+        else:
+            entry = (time.monotonic() + delay, inhibitor.inhibitor_id)
+            heapq.heappush(self._pending_inhibitors, entry)
+            # The timer's already set for something sooner unless this went straight to the front
+            if self._arm_source_id is None or self._pending_inhibitors[0] is entry:
+                self._schedule_arming()
+        return inhibitor.inhibitor_id
+
+    def _schedule_arming(self):
+        if self._arm_source_id is not None:
+            GLib.source_remove(self._arm_source_id)
+            self._arm_source_id = None
+        if self._pending_inhibitors:
+            delay = max(0, self._pending_inhibitors[0][0] - time.monotonic())
+            self._arm_source_id = GLib.timeout_add(int(delay * 1000) + 1, self._arm_pending_inhibitors)
+
+    def _arm_pending_inhibitors(self):
+        self._arm_source_id = None
+        now = time.monotonic()
+        while self._pending_inhibitors and self._pending_inhibitors[0][0] <= now:
+            arm_time, inhibitor_id = heapq.heappop(self._pending_inhibitors)
+            # Inhibitors that were uninhibited during their grace period are just left in the heap until now
+            if inhibitor_id in self.inhibitors and not self.inhibitors[inhibitor_id].armed:
+                self._arm_inhibitor(self.inhibitors[inhibitor_id])
+        self._schedule_arming()
+        return GLib.SOURCE_REMOVE
+
+    def _arm_inhibitor(self, inhibitor: Inhibitor):
+        inhibitor.armed = True
+        self._armed_count += 1
+        import psutil
+        try:
+            inhibitor.process_name = psutil.Process(inhibitor.pid).name()
+        except psutil.NoSuchProcess:
+            inhibitor.process_name = '<exited>'
+        logger.info('Inhibitor requested by "%s" (%s) for reason "%s". Given ID %d',
+                    inhibitor.caller, inhibitor.process_name, inhibitor.reason, inhibitor.inhibitor_id,
+                    extra=inhibitor.log_fields())
         if self.timeout_source_id is None:
-            # AIUI the minimum xscreensaver timeout is 60s, so poke it every 50s.
-            # NOTE: This is exactly what xdg-screensaver does
-            # UPDATE: Changed to 30 seconds because there was some (very rare) circumstances were it skipped 1 poke
-            self.timeout_source_id = GLib.timeout_add_seconds(30, self._inhibitor_func)
-            # Because of Steam (at least) being stupid and constantly Inhibitting then UnInhibiting,
-            # I'm not going to poke the screensaver immediatly because I don't want it to happen before the UnInhibit
-            # # GObject's first run will be after the timeout has run once,
-            # # so run it once immediately as well
-            # self._inhibitor_func()
-            # FIXME: Add support for ignoring certain apps and reasons, mostly because of ^ that Steam shit.
-
-    def del_inhibitor(self, inhibitor_id):
-        assert inhibitor_id in self.inhibitors, "Already removed that inhibitor"
-        print('Removed inhibitor for "{caller}" with ID {ID}'.format(
-            caller=self.inhibitors.pop(inhibitor_id)['caller'], ID=inhibitor_id), file=sys.stderr, flush=True)
-        if len(self.inhibitors) == 0 and self.timeout_source_id is not None:
-            print('Stopping inhibitor timeout')
-            GLib.remove(self.timeout_source_id)
+            # Rather than poking on a fixed timer (xdg-screensaver pokes every 50s, this used to be every 30s)
+            # work out when xscreensaver would actually blank and only poke shortly before then.
+            # Steam's Inhibit/UnInhibit dance is already dealt with by the grace period, so check as soon as _schedule_poke() allows.
+            self._schedule_poke(0)
+
+    def del_inhibitor(self, inhibitor_id, dbus_sender: str = None):
+        """Drop a reference to inhibitor_id, ignoring it if dbus_sender is given and isn't who inhibited it"""
+        if inhibitor_id not in self.inhibitors:
+            # Either ignored by a rule, or the caller already disappeared
+            return
+        inhibitor = self.inhibitors[inhibitor_id]
+        if dbus_sender is not None and inhibitor.dbus_sender != dbus_sender:
+            # Most likely a stale ID from before a restart that's since been given to someone else
+            logger.debug('Ignoring UnInhibit of %d from %s, it belongs to "%s" on %s',
+                         inhibitor_id, dbus_sender, inhibitor.caller, inhibitor.dbus_sender,
+                         extra=inhibitor.log_fields())
+            return
+        inhibitor.refcount -= 1
+        if inhibitor.refcount > 0:
+            self._inhibitors_changed()
+            return
+        self.inhibitors.remove(inhibitor_id)
+        self._inhibitors_changed()
+        self.metrics.observe('xscreensaver_inhibitor_lifetime_seconds', time.time() - inhibitor.created)
+        if not inhibitor.armed:
+            # Never took effect, so there's nothing to undo
+            return
+
+        self._armed_count -= 1
+        logger.info('Removed inhibitor for "%s" with ID %d', inhibitor.caller, inhibitor_id, extra=inhibitor.log_fields())
+        if self._armed_count == 0 and self.timeout_source_id is not None:
+            logger.debug('Stopping inhibitor timeout')
+            GLib.source_remove(self.timeout_source_id)
             self.timeout_source_id = None
+            self._last_poke = None
+
+    def del_sender_inhibitors(self, dbus_sender: str):
+        """Remove every inhibitor belonging to dbus_sender, for when it disconnects without uninhibiting"""
+        for inhibitor in self.inhibitors.lookup(self.inhibitors.by_sender, dbus_sender):
+            logger.info("Inhibitor %d (%s) died without uninhibiting, killing inhibitor", inhibitor.inhibitor_id, inhibitor.caller,
+                        extra=inhibitor.log_fields())
+            inhibitor.refcount = 1
+            self.del_inhibitor(inhibitor.inhibitor_id)
+
+    def _inhibitors_changed(self):
+        if self.state_path and self._save_source_id is None:
+            # Saved a second later rather than straight away, so that Inhibit churn doesn't rewrite the file every call
+            self._save_source_id = GLib.timeout_add_seconds(1, self._scheduled_save)
+        self._update_idle_timer()
+
+    def _update_idle_timer(self):
+        if self.inhibitors and self._idle_source_id is not None:
+            GLib.source_remove(self._idle_source_id)
+            self._idle_source_id = None
+        elif not self.inhibitors and self.idle_timeout and self._idle_source_id is None:
+            self._idle_source_id = GLib.timeout_add_seconds(int(self.idle_timeout), self._idle_timed_out)
+
+    def commands_pending(self):
+        """Whether anyone's still waiting on a response from xscreensaver"""
+        return any(connection._command_in_flight or connection._command_queue for connection in self.connections)
+
+    def _idle_timed_out(self):
+        self._idle_source_id = None
+        if self.commands_pending():
+            # Someone's still waiting on xscreensaver, don't leave them hanging
+            self._idle_source_id = GLib.timeout_add_seconds(1, self._idle_timed_out)
+            return GLib.SOURCE_REMOVE
+        logger.info("No inhibitors for %d seconds, exiting", self.idle_timeout)
+        for callback in self.idle_callbacks:
+            callback()
+        return GLib.SOURCE_REMOVE
+
+    def _scheduled_save(self):
+        self._save_source_id = None
+        self.save_state()
+        return GLib.SOURCE_REMOVE
+
+    def save_state(self):
+        """Write the inhibitors to state_path, so that restore_state() can pick them back up after a restart"""
+        if self._save_source_id is not None:
+            GLib.source_remove(self._save_source_id)
+            self._save_source_id = None
+        if not self.state_path:
+            return
+        try:
+            # NOTE: Still written with no inhibitors, the next start needs next_id so it doesn't hand out IDs someone might still UnInhibit
+            # Write then rename, so a crash halfway through can't leave half a file behind
+            with open(self.state_path + '.tmp', 'w') as state_file:
+                json.dump(self.inhibitors.snapshot(), state_file, separators=(',', ':'))
+            os.replace(self.state_path + '.tmp', self.state_path)
+        except OSError as e:
+            logger.warning("Couldn't save state to %s: %s", self.state_path, e)
+
+    def restore_state(self, still_connected):
+        """
+        Recreate the inhibitors saved by save_state(), for after a crash.
+        still_connected(dbus_sender, pid) decides which ones still belong to something, the rest are dropped.
+        Returns the restored inhibitors.
+        """
+        if not self.state_path:
+            return []
+        try:
+            with open(self.state_path) as state_file:
+                snapshot = json.load(state_file)
+            restored = self.inhibitors.restore(snapshot, still_connected)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring unusable state file %s: %s", self.state_path, e)
+            return []
+
+        for inhibitor, armed in restored:
+            logger.info('Restored inhibitor %d for "%s"', inhibitor.inhibitor_id, inhibitor.caller, extra=inhibitor.log_fields())
+            if armed:
+                # Already made it through the grace period last time
+                self._arm_inhibitor(inhibitor)
+            else:
+                heapq.heappush(self._pending_inhibitors, (time.monotonic() + self.grace_period, inhibitor.inhibitor_id))
+        self._schedule_arming()
+        self._inhibitors_changed()
+        return [inhibitor for inhibitor, armed in restored]
+
+    def _get_xscreensaver_timeout(self):
+        if self.xscreensaver_timeout is not None:
+            # xscreensaver won't go below this either, and anything under POKE_MARGIN would have us poking constantly
+            return max(self.xscreensaver_timeout, MIN_XSCREENSAVER_TIMEOUT)
+        config_path = os.path.expanduser('~/.xscreensaver')
+        try:
+            mtime = os.stat(config_path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self._xscreensaver_config_mtime:
+            self._xscreensaver_config_mtime = mtime
+            self._config_timeout = max(read_xscreensaver_timeout(config_path) or 0, MIN_XSCREENSAVER_TIMEOUT)
+        return self._config_timeout
+
+    def _time_until_blank(self, connections):
+        """Roughly how many seconds until xscreensaver would blank the first of connections' displays if nothing pokes it"""
+        # xscreensaver's idle timer gets reset by user input, by our pokes, and by the screen unblanking.
+        # If we don't know one of those it's left out, which can only make this too early, never too late.
+        longest_idle = 0
+        for connection in connections:
+            idle_times = [connection.get_idle_time(max_age=0)]
+            if self._last_poke is not None:
+                idle_times.append(time.monotonic() - self._last_poke)
+            if connection.status[0] == "UNBLANK":
+                idle_times.append(time.time() - connection.status[1])
+            idle_times = [i for i in idle_times if i is not None]
+            if not idle_times:
+                return 0
+            longest_idle = max(longest_idle, min(idle_times))
+        return self._get_xscreensaver_timeout() - longest_idle
+
+    def _schedule_poke(self, delay: float):
+        if self.timeout_source_id is not None:
+            GLib.source_remove(self.timeout_source_id)
+        # A 0ms timeout would just spin the main loop if something keeps asking for one
+        delay = max(delay, MIN_POKE_DELAY)
+        if delay >= 1:
+            # Whole seconds let GLib group this wakeup with others, it may run slightly late but POKE_MARGIN allows for that
+            self.timeout_source_id = GLib.timeout_add_seconds(int(delay), self._inhibitor_func)
+        else:
+            self.timeout_source_id = GLib.timeout_add(int(delay * 1000), self._inhibitor_func)
 
     def _inhibitor_func(self):
-        # This for loop must run on a copy of the dict so that it can pop things from the original dict.
-        # Otherwise the for loop crashes with "RuntimeError: dictionary changed size during iteration"
-        for inhibitor_id in self.inhibitors.copy():
-            # NOTE: psutil confirms the pid hasn't been reused, so don't need to worry about that.
-            if not self.inhibitors[inhibitor_id]['caller_process'].is_running():
-                print("Inhibitor {inhibitor_id} ({caller}) died without uninhibiting, killing inhibitor".format(
-                      inhibitor_id=inhibitor_id, caller=self.inhibitors[inhibitor_id]['caller']))
-                self.inhibitors.pop(inhibitor_id)
-
-        if len(self.inhibitors) == 0:
-            print("Inhibitors finished")
-            self.timeout_source_id = None
+        # NOTE: Callers that die without uninhibiting are cleaned up by del_sender_inhibitors as soon as they leave the bus,
+        #       so all this needs to do is poke xscreensaver.
+        self.timeout_source_id = None
+        if self._armed_count == 0:
+            logger.debug("Inhibitors finished")
             return GLib.SOURCE_REMOVE
+
+        # Poking a display that's already blanked would unblank it, so only the unblanked ones get poked
+        unblanked = [connection for connection in self.connections if connection.status[0] == "UNBLANK"]
+        if not unblanked:
+            self.metrics.inc('xscreensaver_pokes_skipped_total', reason='blanked')
+            # Screen currently locked/blanked, don't poke it.
+            # FIXME: Perhaps should also invalidate all active inhibitors?
+            # Once it unblanks xscreensaver's idle timer starts again from 0, so check back in a full timeout.
+            self._schedule_poke(self._get_xscreensaver_timeout() - POKE_MARGIN)
+            return GLib.SOURCE_REMOVE
+
+        time_until_blank = self._time_until_blank(unblanked)
+        if time_until_blank > POKE_MARGIN:
+            # The user's been active recently enough that xscreensaver isn't about to blank yet, no need to poke.
+            self.metrics.inc('xscreensaver_pokes_skipped_total', reason='user_active')
+            self._schedule_poke(time_until_blank - POKE_MARGIN)
         else:
-            if self.get_active():
-                # Screen currently locked/blanked, don't poke it.
-                # FIXME: Perhaps should also invalidate all active inhibitors?
-                pass
-            else:
-                print("Poking screensaver for inhibitors:",
-                      ', '.join([i['caller'] for i in self.inhibitors.values()]),
-                      file=sys.stderr, flush=True)
-                response = self.send_command("DEACTIVATE")
-                if response != '+not active: idle timer reset.':
-                    print("XSS response:", response, file=sys.stderr, flush=True)
-            return GLib.SOURCE_CONTINUE
+            logger.info("Poking screensaver for inhibitors: %s", ', '.join(self.inhibitors.by_caller), extra={'command': "DEACTIVATE"})
+            self.metrics.inc('xscreensaver_pokes_total')
+            for connection in unblanked:
+                connection.queue_command("DEACTIVATE", self._poke_response, self._poke_error)
+            # NOTE: _last_poke only gets updated once xscreensaver says it got the poke, see _poke_response()
+            self._schedule_poke(self._get_xscreensaver_timeout() - POKE_MARGIN)
+        # The next check has already been scheduled as a new timeout
+        return GLib.SOURCE_REMOVE
+
+    def _poke_response(self, response):
+        if not response.startswith('+'):
+            self._poke_error(response)
+            return
+        if response != '+not active: idle timer reset.':
+            logger.warning("XSS response: %s", response, extra={'command': "DEACTIVATE"})
+        if self._armed_count:
+            self._last_poke = time.monotonic()
+
+    def _poke_error(self, error):
+        logger.warning("XSS poke failed: %s", error, extra={'command': "DEACTIVATE"})
+        # xscreensaver's idle timer wasn't reset, so don't count on it having been, and try again soon
+        self._last_poke = None
+        if self._armed_count:
+            self._schedule_poke(POKE_RETRY_DELAY)
+
+
+def measured(method):
+    """
+    Record how long a DBus method takes in self.action_handler.metrics.
+    Async methods are timed until they reply, so that includes waiting for xscreensaver.
+    NOTE: Must go above @dbus.service.method, which needs to see the real method's arguments.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        started = time.monotonic()
+
+        def finished():
+            self.action_handler.metrics.observe('xscreensaver_dbus_method_seconds', time.monotonic() - started,
+                                                method=method.__name__)
+
+        if 'reply_handler' not in kwargs:
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                finished()
+
+        reply_handler, error_handler = kwargs['reply_handler'], kwargs['error_handler']
+
+        def timed_reply(*reply):
+            finished()
+            reply_handler(*reply)
+
+        def timed_error(error):
+            finished()
+            error_handler(error)
+
+        kwargs.update(reply_handler=timed_reply, error_handler=timed_error)
+        return method(self, *args, **kwargs)
+    return wrapper
 
 
 class DBusListener(dbus.service.Object):
@@ -178,47 +1007,104 @@ class DBusListener(dbus.service.Object):
         # This is just to avoid needing to initialise another bus connection, etc.
         self._get_procid = session_bus.get_object('org.freedesktop.DBus', '/').GetConnectionUnixProcessID
 
+        # Watching for each inhibiting caller's bus connection to close, so their inhibitors can be removed immediately.
+        # NOTE: Unique bus names are never reused, so once the owner is gone it's gone for good.
+        self._session_bus = session_bus
+        self._name_watches = {}
+
+        # Pick up any inhibitors from before a crash, as long as whoever asked for them is still around
+        for inhibitor in self.action_handler.restore_state(self._still_connected):
+            self._watch_sender(inhibitor.dbus_sender)
+
+        self._active = self.action_handler.get_active()
+        self.action_handler.watch(self._status_changed)
+
+    def _status_changed(self, state, since):
+        # BLANK -> LOCK is still active, so only signal when it actually goes between active and inactive
+        active = state != "UNBLANK"
+        if active != self._active:
+            self._active = active
+            self.ActiveChanged(active)
+
+    def _still_connected(self, dbus_sender: str, pid: int):
+        """Whether dbus_sender is still on the bus, and is still the same process it was"""
+        # NOTE: Unique bus names are never reused by the same bus, but a restarted bus starts counting again
+        try:
+            return bool(self._session_bus.name_has_owner(dbus_sender)) and int(self._get_procid(dbus_sender)) == pid
+        except dbus.DBusException:
+            return False
+
+    def _watch_sender(self, dbus_sender: str):
+        if dbus_sender not in self._name_watches:
+            self._name_watches[dbus_sender] = self._session_bus.watch_name_owner(
+                dbus_sender, functools.partial(self._sender_owner_changed, dbus_sender))
+
+    def _sender_owner_changed(self, dbus_sender: str, new_owner: str):
+        # This also gets called once straight away with the current owner, which is just the sender itself
+        if new_owner == '':
+            self._name_watches.pop(dbus_sender).cancel()
+            self.action_handler.del_sender_inhibitors(dbus_sender)
+
+    @dbus.service.signal("org.freedesktop.ScreenSaver", signature='b')
+    def ActiveChanged(self, new_value):
+        """Emitted when the locker is activated or deactivated"""
+        pass
+
+    @measured
     @dbus.service.method("org.freedesktop.ScreenSaver")
     def GetActive(self):
         """Query the state of the locker"""
         return dbus.Boolean(self.action_handler.get_active())
 
-    @dbus.service.method("org.freedesktop.ScreenSaver")
+    # NOTE: These all answer from what XSS_worker already knows, so clients polling them don't cost any X traffic.
+
+    @measured
+    @dbus.service.method("org.freedesktop.ScreenSaver", out_signature='u')
     def GetActiveTime(self):
         """Query the length of time the locker has been active"""
         # xscreenssaver-command -time
-        pass
+        return dbus.UInt32(self.action_handler.get_active_time())
 
-    @dbus.service.method("org.freedesktop.ScreenSaver")
+    @measured
+    @dbus.service.method("org.freedesktop.ScreenSaver", out_signature='u')
     def GetSessionIdleTime(self):
         """Query the idle time of the locker"""
         # Doesn't have it's own dedicated light-locker-command argument,
         # but gets called instead of GetActiveTime when GetActive returns False
+        idle = self.action_handler.get_idle_time()
+        return dbus.UInt32(idle if idle is not None else 0)
 
-        # xscreenssaver-command -time ?
-        pass
+    # NOTE: The methods that send xscreensaver commands reply asynchronously,
+    #       so that waiting for xscreensaver doesn't hold up the main loop and every other DBus client along with it.
 
-    @dbus.service.method("org.freedesktop.ScreenSaver")
-    def Lock(self):
+    @measured
+    @dbus.service.method("org.freedesktop.ScreenSaver", async_callbacks=('reply_handler', 'error_handler'))
+    def Lock(self, reply_handler, error_handler):
         """Tells the running locker process to lock the screen immediately"""
         # xscreenssaver-command -lock
-        self.action_handler.send_command("LOCK")
+        self.action_handler.queue_command("LOCK", lambda responses: reply_handler(), error_handler)
 
-    @dbus.service.method("org.freedesktop.ScreenSaver")
-    def SetActive(self, activate):
+    @measured
+    @dbus.service.method("org.freedesktop.ScreenSaver", async_callbacks=('reply_handler', 'error_handler'))
+    def SetActive(self, activate, reply_handler, error_handler):
         """Blank or unblank the screensaver"""
         # xscreensaver-command -deactivate or -activate
         activate = bool(activate)  # DBus booleans turn into ints, I want bools
-        resp = self.action_handler.send_command("ACTIVATE" if activate else "DEACTIVATE")
-        return dbus.Boolean(  # NOTE: return True for success, not True for "activated"
-            resp == ('+activating.' if activate else '+deactivating.')
-        )
+        self.action_handler.queue_command(
+            "ACTIVATE" if activate else "DEACTIVATE",
+            # NOTE: return True for success, not True for "activated"
+            #       With multiple displays that means success on all of them.
+            lambda responses: reply_handler(dbus.Boolean(all(response == ('+activating.' if activate else '+deactivating.')
+                                                             for response in responses))),
+            error_handler)
 
-    @dbus.service.method("org.freedesktop.ScreenSaver")
-    def SimulateUserActivity(self):
+    @measured
+    @dbus.service.method("org.freedesktop.ScreenSaver", async_callbacks=('reply_handler', 'error_handler'))
+    def SimulateUserActivity(self, reply_handler, error_handler):
         """Poke the running locker to simulate user activity"""
-        self.action_handler.send_command("DEACTIVATE")
+        self.action_handler.queue_command("DEACTIVATE", lambda responses: reply_handler(), error_handler)
 
+    @measured
     @dbus.service.method("org.freedesktop.ScreenSaver", sender_keyword='dbus_sender')
     def Inhibit(self, caller: dbus.String, reason: dbus.String, dbus_sender: str):
         """Inhibit the screensaver from activating. Terminate the light-locker-command process to end inhibition."""
@@ -230,21 +1116,101 @@ class DBusListener(dbus.service.Object):
         #       It's Steam, I don't understand wtf it's doing since it should probably be calling SimulateUserActivity.
         #       I suspect when an actual game is running it won't UnInhibit, but I haven't investigated that.
 
-        # Since DBus uses 32bit integers, make sure isn't any larger than that
-        # NOTE: I could start at 0, but I've decided not to for easier debugging
-        # FIXME: This won't handle randomly generating duplicates
-        inhibitor_id = random.randint(1, 4294967296)
-        self.action_handler.add_inhibitor(inhibitor_id, caller=caller, reason=reason,
-                                          caller_process=psutil.Process(self._get_procid(dbus_sender)))
+        inhibitor_id = self.action_handler.add_inhibitor(caller=caller, reason=reason, dbus_sender=dbus_sender,
+                                                         pid=int(self._get_procid(dbus_sender)))
+        self._watch_sender(dbus_sender)
         return dbus.UInt32(inhibitor_id)
 
-    @dbus.service.method("org.freedesktop.ScreenSaver")
-    def UnInhibit(self, inhibitor_id):
-        self.action_handler.del_inhibitor(inhibitor_id)
+    @measured
+    @dbus.service.method("org.freedesktop.ScreenSaver", sender_keyword='dbus_sender')
+    def UnInhibit(self, inhibitor_id, dbus_sender: str):
+        self.action_handler.del_inhibitor(int(inhibitor_id), dbus_sender=dbus_sender)
         # print("UnInhibit called for inhibitor", int(inhibitor_id))
 
+    @staticmethod
+    def _inhibitor_struct(inhibitor: Inhibitor):
+        return dbus.Struct((dbus.UInt32(inhibitor.inhibitor_id), inhibitor.caller, inhibitor.reason, inhibitor.dbus_sender,
+                            dbus.UInt32(inhibitor.pid), inhibitor.process_name or '', dbus.Double(inhibitor.created)),
+                           signature='usssusd')
+
+    @dbus.service.method(INSPECT_INTERFACE, out_signature='a(usssusd)')
+    def ListInhibitors(self):
+        """List every inhibitor as (ID, caller, reason, DBus sender, PID, process name, creation time)"""
+        return dbus.Array((self._inhibitor_struct(i) for i in self.action_handler.inhibitors), signature='(usssusd)')
+
+    @dbus.service.method(INSPECT_INTERFACE, in_signature='s', out_signature='a(usssusd)')
+    def ListInhibitorsForCaller(self, caller):
+        """Same as ListInhibitors, but only the inhibitors requested with the given caller (application) name"""
+        inhibitors = self.action_handler.inhibitors
+        return dbus.Array((self._inhibitor_struct(i) for i in inhibitors.lookup(inhibitors.by_caller, str(caller))),
+                          signature='(usssusd)')
+
+    @dbus.service.method(INSPECT_INTERFACE, in_signature='u', out_signature='a(usssusd)')
+    def ListInhibitorsForPID(self, pid):
+        """Same as ListInhibitors, but only the inhibitors requested by the given process ID"""
+        inhibitors = self.action_handler.inhibitors
+        return dbus.Array((self._inhibitor_struct(i) for i in inhibitors.lookup(inhibitors.by_pid, int(pid))),
+                          signature='(usssusd)')
+
+    @dbus.service.method(INSPECT_INTERFACE, out_signature='a{sd}')
+    def GetStats(self):
+        """
+        Every counter, gauge, and histogram bucket the daemon keeps, as {series: value}.
+        Series are named the same as the Prometheus dump from --metrics-socket, eg. 'xscreensaver_pokes_total'.
+        """
+        return dbus.Dictionary(self.action_handler.metrics.as_dict(), signature='sd')
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="org.freedesktop.ScreenSaver DBus service for xscreensaver")
+    parser.add_argument('--grace-period', type=float, default=5,
+                        help="Seconds an inhibitor must last before it takes effect (default: %(default)s)")
+    parser.add_argument('--rules', default=DEFAULT_RULES_PATH,
+                        help="INI file of per-application inhibitor rules (default: %(default)s)")
+    parser.add_argument('--xscreensaver-timeout', type=int, default=None,
+                        help="xscreensaver's blank timeout in seconds, at least {minimum} (default: read from ~/.xscreensaver)".format(
+                            minimum=MIN_XSCREENSAVER_TIMEOUT))
+    parser.add_argument('--display', '-d', action='append', dest='displays',
+                        help="X display to control, can be given multiple times (default: $DISPLAY)")
+    parser.add_argument('--metrics-socket', default=None,
+                        help="Unix socket to serve Prometheus text format metrics on (default: don't)")
+    parser.add_argument('--idle-timeout', type=float, default=0,
+                        help="Exit after this many seconds without any inhibitors, for use with DBus activation (default: never)")
+    parser.add_argument('--state-file', default=DEFAULT_STATE_PATH,
+                        help="Where to keep inhibitors so they survive a restart (default: %(default)s)")
+    parser.add_argument('--log-level', default='info', choices=('debug', 'info', 'warning', 'error'),
+                        help="Only log messages this important or more (default: %(default)s)")
+    parser.add_argument('--log-format', default='text', choices=('text', 'json'),
+                        help="text is the message followed by key=value fields, json is 1 object per line (default: %(default)s)")
+    args = parser.parse_args()
+    if args.xscreensaver_timeout is not None and args.xscreensaver_timeout < MIN_XSCREENSAVER_TIMEOUT:
+        parser.error("--xscreensaver-timeout can't be less than {minimum}, xscreensaver doesn't allow it".format(
+            minimum=MIN_XSCREENSAVER_TIMEOUT))
+
+    log_handler = MainLoopLogHandler(sys.stderr)
+    log_handler.setFormatter(JSONFormatter() if args.log_format == 'json' else KeyValueFormatter('%(levelname)s: %(message)s'))
+    logging.basicConfig(level=args.log_level.upper(), handlers=[log_handler])
+
+    rules = InhibitRules.load(args.rules) if os.path.exists(args.rules) else None
+
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-    DBusListener(XSS_worker())  # The object this returns is useless because it'll get dealt with by GObject
-    GLib.MainLoop().run()
+    worker = XSS_worker(grace_period=args.grace_period, rules=rules, xscreensaver_timeout=args.xscreensaver_timeout,
+                        display_names=args.displays or (None,), idle_timeout=args.idle_timeout, state_path=args.state_file)
+    if args.metrics_socket:
+        MetricsSocket(args.metrics_socket, worker.metrics)
+    main_loop = GLib.MainLoop()
+    # The object this returns is useless because it'll get dealt with by GObject
+    DBusListener(worker)
+    # NOTE: There's no point giving up the bus name first and finishing off whatever calls are on their way,
+    #       systemd treats a Type=dbus unit dropping its name as it having stopped and sends SIGTERM anyway.
+    #       Anything that calls between now and the name going away gets an error, the next call activates a new daemon,
+    #       and the state file hands over any inhibitors that snuck in.
+    worker.idle_callbacks.append(main_loop.quit)
+
+    def stop():
+        main_loop.quit()
+        return GLib.SOURCE_REMOVE
+    # systemd stops us with SIGTERM, exit through the main loop so the state gets saved and the logs get flushed
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, stop)
+    main_loop.run()
+    worker.save_state()
@@ -1,92 +1,563 @@
 #!/usr/bin/env python3
-# FIXME: Currently this only activate/deactivate & lock, and maybe some status querying.
+# FIXME: Currently this only does the xscreensaver-command verbs that don't need a GUI, so no -demo or -prefs.
 #
-#        I would like to improve this in future to implement xscreensaver-command's -watch functionality
-#        NOTE: xscreensaver-command.c did this with what looks like simply a "while true: GetActiveTime()" loop.
+# NOTE: xscreensaver-command.c implemented -watch with what looks like simply a "while true: GetActiveTime()" loop.
+#       Instead this listens for PropertyNotify events on the root window's _SCREENSAVER_STATUS,
+#       so it's not waking up at all unless xscreensaver's state actually changes.
 
+import argparse
+import json
+import os
+import select
 import sys
 import time
 
-# FIXME: Xlib is obsolete and should be replaced.
-#        I guess technically it'd be replaced by DBus,
-#        so maybe it's completely valid for me to use it here while xscreensaver doesn't natively support dbus?
-import Xlib.Xatom
-import Xlib.display
-import Xlib.protocol
-
-
-# FIXME: Turn this into its own "xscreensaver_command" library and import that.
-class XSS_worker():
-    timeout_source_id = None
-
-    def __init__(self):
-        self.inhibitors = {}  # Must be set in the __init__ function because of list immutability
-
-        self.display = Xlib.display.Display()
-
-        ## Find the xscreensaver window.
-        screensavers = [child for child in self.display.screen().root.query_tree().children
-                        if child.get_full_property(self.display.intern_atom("_SCREENSAVER_VERSION", False), Xlib.Xatom.STRING)]
-        # FIXME: Use actual exceptions
-        ## Actually we can have multiple screensaver windows because there's 1 for each output display.
-        ## xscreensaver-command stops at the first one it finds, so we'll do the same.
-        # assert not len(screensavers) > 1, "Can't have multiple screensaver windows!"
-        assert not len(screensavers) < 1, "No screensaver window found. Is there a screensaver running?"
-        # Don't actually want a list, it was just the easiest way to loop over the query_tree and assert only 1 window
-        self.xss_window = screensavers[0]
-
-        ## Set the event_mask se that responses can be caught
-        self.xss_window.change_attributes(event_mask=Xlib.X.PropertyChangeMask)
-
-    def _send_command(self, atom_name):
-        Xevent = Xlib.protocol.event.ClientMessage(
-            display=self.display,
-            window=self.xss_window,
-            client_type=self.display.intern_atom("SCREENSAVER", False),
-            # In the C code the last [0, 0] happened implicitly, Python's xlib doesn't cope well with them being left out though.
-            # The first [0, 0] was set according to certain other arguments, but for DEACTIVATE was always [0, 0]
-            data=(32, [self.display.intern_atom(atom_name, False), 0, 0, 0, 0]),
-        )
-        self.display.send_event(destination=Xevent.window,
-                                propagate=False,
-                                event_mask=0,
-                                event=Xevent,
-                                # FIXME: Should raise an exception here
-                                onerror=lambda err: print('ERROR:', err, file=sys.stderr, flush=True))
-
-        # FIXME: Does every command send a response?
-        #        Should I leave this part for the parent function?
-        return self._get_response()
-
-    def _get_response(self):
+Xlib = None
+
+# Every atom the xscreensaver protocol uses, see xscreensaver's remote.c.
+# These all get interned once when connecting so that sending commands doesn't need any extra round trips.
+PROTOCOL_ATOMS = (
+    "SCREENSAVER", "_SCREENSAVER_VERSION", "_SCREENSAVER_RESPONSE", "_SCREENSAVER_ID", "_SCREENSAVER_STATUS",
+    # Commands
+    "ACTIVATE", "DEACTIVATE", "CYCLE", "NEXT", "PREV", "SELECT", "EXIT", "RESTART", "DEMO", "PREFS", "LOCK", "THROTTLE",
+    "UNTHROTTLE",
+    # Status values
+    "BLANK",
+)
+
+# How many top-level windows on each screen to ask for _SCREENSAVER_VERSION at once while looking for xscreensaver
+DISCOVERY_BATCH_SIZE = 64
+# How long a get_idle_time() answer can be reused before asking the X server again
+IDLE_TIME_MAX_AGE = 1
+
+
+# Command line verbs, and how many arguments each one takes
+VERBS = {
+    'activate': 0, 'deactivate': 0, 'lock': 0, 'cycle': 0, 'next': 0, 'prev': 0, 'select': 1,
+    'time': 0, 'version': 0, 'restart': 0, 'exit': 0,
+}
+# These only read properties rather than asking xscreensaver to do anything, so they can be pipelined
+READ_VERBS = ('time', 'version')
+
+
+def _load_xlib():
+    """
+    Import Xlib the first time something needs it rather than when this is imported,
+    it's most of the startup time and nothing needs it until the first XSS_connection.
+    """
+    global Xlib
+    # FIXME: Xlib is obsolete and should be replaced.
+    #        I guess technically it'd be replaced by DBus,
+    #        so maybe it's completely valid for me to use it here while xscreensaver doesn't natively support dbus?
+    import Xlib.X
+    import Xlib.Xatom
+    import Xlib.display
+    import Xlib.error
+    import Xlib.ext.screensaver
+    import Xlib.protocol
+    import Xlib.protocol.request
+
+
+class XSSTimeoutError(TimeoutError):
+    """xscreensaver didn't respond to a command before the response timeout"""
+
+
+class NoScreensaverError(RuntimeError):
+    """Couldn't find an xscreensaver window on the display"""
+
+
+def intern_atoms(display: 'Xlib.display.Display', names):
+    """Intern all of names in a single round trip, returning a {name: atom} dict"""
+    _load_xlib()
+    # Display.intern_atom() waits for each reply before sending the next request,
+    # instead send all the requests first then collect the replies.
+    requests = [Xlib.protocol.request.InternAtom(display=display.display, name=name, only_if_exists=False, defer=True)
+                for name in names]
+    display.flush()
+    atoms = {}
+    for name, request in zip(names, requests):
+        request.reply()
+        atoms[name] = request.atom
+    return atoms
+
+
+def _get_property_requests(display: 'Xlib.display.Display', windows, property, property_type, long_length=0):
+    """Send a GetProperty for every window without waiting for any replies, call .reply() on each result to collect them"""
+    return [Xlib.protocol.request.GetProperty(display=display.display, defer=True, delete=False,
+                                              window=window, property=property,
+                                              type=property_type, long_offset=0, long_length=long_length)
+            for window in windows]
+
+
+def window_cache_path(display: 'Xlib.display.Display'):
+    """Where to remember the xscreensaver window IDs between runs, or None if there's nowhere suitable"""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        return None
+    return os.path.join(runtime_dir, 'xscreensaver-window{display}'.format(
+        display=display.get_display_name().replace('/', '_')))
+
+
+def _are_xss_windows(display: 'Xlib.display.Display', atoms: dict, windows):
+    """Whether each of windows belongs to xscreensaver, asking about all of them in 1 round trip"""
+    # Only care whether the property exists, not what's in it, so don't fetch any of the value
+    requests = _get_property_requests(display, windows, atoms["_SCREENSAVER_VERSION"], Xlib.Xatom.STRING)
+    display.flush()
+    results = []
+    for request in requests:
+        try:
+            request.reply()
+        except Xlib.error.BadWindow:
+            # Window was destroyed since we heard about it, can't have been one we want
+            results.append(False)
+            continue
+        results.append(bool(request.property_type))
+    return results
+
+
+def find_xss_windows(display: 'Xlib.display.Display', atoms: dict):
+    """
+    Find the xscreensaver window on every screen, trying the last known windows before searching every top-level window.
+    Also selects the events needed to catch responses and notice xscreensaver exiting on each of them.
+    atoms needs at least the PROTOCOL_ATOMS, as returned by intern_atoms().
+    """
+    _load_xlib()
+    xss_windows = []
+    cache_path = window_cache_path(display)
+    if cache_path:
+        try:
+            with open(cache_path) as cache_file:
+                cached = [display.create_resource_object('window', int(window_id))
+                          for window_id in cache_file.read().split()]
+        except (OSError, ValueError):
+            cached = []
+        # If any of them are gone xscreensaver has probably restarted, so search for all of the new ones
+        if cached and all(_are_xss_windows(display, atoms, cached)):
+            xss_windows = cached
+
+    if not xss_windows:
+        # Actually we can have multiple screensaver windows because there's 1 for each screen.
+        # xscreensaver-command stops at the first one it finds, we want the one on each screen so there's a spare if one goes away.
+        # Each screen only has the 1 though, so stop searching a screen as soon as it turns up.
+        children = [display.screen(screen_number).root.query_tree().children for screen_number in range(display.screen_count())]
+        found = [None] * len(children)
+        for batch_start in range(0, max(len(screen_children) for screen_children in children), DISCOVERY_BATCH_SIZE):
+            # Each round trip asks about the next DISCOVERY_BATCH_SIZE windows on every screen that's still being searched
+            batch = [(screen_number, window)
+                     for screen_number, screen_children in enumerate(children) if found[screen_number] is None
+                     for window in screen_children[batch_start:batch_start + DISCOVERY_BATCH_SIZE]]
+            if not batch:
+                break
+            for (screen_number, window), is_xss in zip(batch, _are_xss_windows(display, atoms, [window for _, window in batch])):
+                if is_xss and found[screen_number] is None:
+                    found[screen_number] = window
+        xss_windows = [window for window in found if window is not None]
+
+        if not xss_windows:
+            raise NoScreensaverError("No screensaver window found on {display}. Is there a screensaver running?".format(
+                display=display.get_display_name()))
+        if cache_path:
+            try:
+                with open(cache_path, 'w') as cache_file:
+                    cache_file.write(' '.join(str(window.id) for window in xss_windows))
+            except OSError:
+                pass
+
+    for window in xss_windows:
+        ## Set the event_mask so that responses can be caught, and so we notice if xscreensaver exits
+        window.change_attributes(event_mask=Xlib.X.PropertyChangeMask | Xlib.X.StructureNotifyMask)
+    return xss_windows
+
+
+def send_command(display: 'Xlib.display.Display', atoms: dict, window, atom_name: str, argument: int = 0):
+    """
+    Send a command to one xscreensaver window without waiting for the response,
+    returning a CatchError that catches the BadWindow if that window's already gone.
+    """
+    _load_xlib()
+    bad_window = Xlib.error.CatchError(Xlib.error.BadWindow)
+    Xevent = Xlib.protocol.event.ClientMessage(
+        display=display,
+        window=window,
+        client_type=atoms["SCREENSAVER"],
+        # In the C code the last [0, 0] happened implicitly, Python's xlib doesn't cope well with them being left out though.
+        # The first [0, 0] was set according to certain other arguments, only SELECT & DEMO actually have one.
+        data=(32, [atoms[atom_name], argument, 0, 0, 0]),
+    )
+    display.send_event(destination=Xevent.window,
+                       propagate=False,
+                       event_mask=0,
+                       event=Xevent,
+                       onerror=bad_window)
+    # Make sure it's actually been sent before anyone waits for the response
+    display.flush()
+    return bad_window
+
+
+class _XSSWindowGone(Exception):
+    """The xscreensaver window a command was sent to doesn't exist anymore"""
+
+
+class Response():
+    """
+    One display's answer to a command.
+    ok is False if xscreensaver refused, message is the response without xscreensaver's +/- prefix,
+    and data has anything else the command found out, like the state for "time".
+    """
+    __slots__ = ('command', 'display', 'ok', 'message', 'data')
+
+    def __init__(self, command: str, display: str, ok: bool, message: str, data: dict = None):
+        self.command = command
+        self.display = display
+        self.ok = ok
+        self.message = message
+        self.data = data or {}
+
+    @classmethod
+    def parse(cls, command: str, display: str, response: str):
+        """Turn one of xscreensaver's responses like '+activating.' or '-not active: can't cycle.' into a Response"""
+        if response[:1] in ('+', '-'):
+            return cls(command, display, response[0] == '+', response[1:])
+        return cls(command, display, False, response)
+
+    def as_dict(self):
+        result = {'command': self.command, 'display': self.display, 'ok': self.ok, 'message': self.message}
+        result.update(self.data)
+        return result
+
+    def __str__(self):
+        return self.message
+
+    def __repr__(self):
+        return '<Response to {command} from {display}: {sign}{message}>'.format(
+            command=self.command, display=self.display, sign='+' if self.ok else '-', message=self.message)
+
+
+class XSS_connection():
+    """
+    One persistent connection to an X display, and every xscreensaver window on each of its screens.
+    XSS_worker keeps a pool of these, one per display.
+    Everything here blocks, dbus-xscreensaver.py subclasses it to be driven from the GLib main loop instead.
+    """
+    def __init__(self, display_name: str = None):
+        _load_xlib()
+        self.display = Xlib.display.Display(display_name)
+        self.atoms = intern_atoms(self.display, PROTOCOL_ATOMS)
+        # _SCREENSAVER_STATUS[0] is the atom of the current state, or 0 when not blanked
+        self.status_names = {self.atoms["BLANK"]: "BLANK", self.atoms["LOCK"]: "LOCK", 0: "UNBLANK"}
+        # Whether _SCREENSAVER_STATUS has changed since watch() last looked at it
+        self._status_changed = False
+        # (state, timestamp) as of the last _SCREENSAVER_STATUS read, or None if it's changed since then
+        self.status = None
+        self._idle_time = (None, None)  # (idle seconds, time.monotonic() when fetched)
+        self._has_idle_time = self.display.has_extension('MIT-SCREEN-SAVER')
+        # xscreensaver only sets _SCREENSAVER_STATUS on the first screen's root window, even when it's running on all of them.
+        # Ask for PropertyNotify events on it so we know when the status needs reading again
+        self.status_root = self.display.screen(0).root
+        self.status_root.change_attributes(event_mask=Xlib.X.PropertyChangeMask)
+
+        # There's 1 xscreensaver window for each screen, commands go to the first one and the rest are spares for when it goes away.
+        self.xss_windows = []
+        self._command_window = None
+        # The last response _handle_event() found, until _poll_response() picks it up
+        self._response = None
+        self._find_xss_windows()
+
+    def fileno(self):
+        """So connections can be passed straight to select()"""
+        return self.display.fileno()
+
+    def _find_xss_windows(self):
+        self.xss_windows = find_xss_windows(self.display, self.atoms)
+
+    def _forget_window(self, window_id):
+        """That xscreensaver window is gone, fall back to the next one or find them all again next time if that was the last"""
+        self.xss_windows = [window for window in self.xss_windows if window.id != window_id]
+
+    def _start_command(self, atom_name, argument: int = 0):
+        """Send a command to xscreensaver without waiting for the response, returning the error catcher for _poll_response()"""
+        if not self.xss_windows:
+            self._find_xss_windows()
+        self._command_window = self.xss_windows[0]
+        # Anything already there was for some earlier command that timed out
+        self._response = None
+        return send_command(self.display, self.atoms, self._command_window, atom_name, argument)
+
+    def _poll_response(self, bad_window: 'Xlib.error.CatchError'):
+        """
+        Check for xscreensaver's response to a command without blocking, returning None if it hasn't arrived yet.
+        Raises _XSSWindowGone if bad_window caught an error because the xscreensaver window went away.
+        """
+        self._process_events()
+        if self._response is not None:
+            response, self._response = self._response, None
+            return response
+
+        if bad_window.get_error():
+            self._forget_window(self._command_window.id)
+            raise _XSSWindowGone()
+        return None
+
+    def _handle_event(self, ev):
+        """Deal with a single event from the X server"""
         # NOTE: I've already set the necessary event mask for the xscreensaver window object to include Xlib.X.PropertyChangeMask
-        response = None  # So the assert below actually triggers rather than a UnboundLocalError
-        timeout = time.monotonic() + 1
-        while time.monotonic() < timeout:  # If there hasn't been a response in 1 second, there won't be one
-            if self.display.pending_events():
-                ev = self.display.next_event()
-                if ev.type == Xlib.X.PropertyNotify and \
-                   ev.state == Xlib.X.PropertyNewValue and \
-                   ev.atom == self.display.intern_atom("_SCREENSAVER_RESPONSE", False):
-                        # NOTE: The C code accepts AnyPropertyType, not just Strings, I'm being more defensive here.
-                        # FIXME: Can there be multiple responses all at once? Should we wait the whole second and add them all up?
-                        # FIXME: Can I just get the property info from the event object?
-                        response = ev.window.get_full_property(
-                            self.display.intern_atom("_SCREENSAVER_RESPONSE", False),
-                            Xlib.Xatom.STRING)
-                        break
-        assert response, "No response recieved"
-        return str(response.value).strip()
+        if ev.type == Xlib.X.PropertyNotify and \
+           ev.state == Xlib.X.PropertyNewValue and \
+           ev.atom == self.atoms["_SCREENSAVER_RESPONSE"]:
+            # NOTE: The C code accepts AnyPropertyType, not just Strings, I'm being more defensive here.
+            # FIXME: Can I just get the property info from the event object?
+            response = ev.window.get_full_property(self.atoms["_SCREENSAVER_RESPONSE"], Xlib.Xatom.STRING)
+            if response:
+                # Format 8 properties come back as bytes, not str
+                self._response_arrived(response.value.decode('latin-1').strip('\0').strip())
+        elif ev.type == Xlib.X.DestroyNotify:
+            # xscreensaver exited or restarted, forget about the old window so it gets found again next time
+            self._forget_window(ev.window.id)
+        elif ev.type == Xlib.X.PropertyNotify and \
+             ev.state == Xlib.X.PropertyNewValue and \
+             ev.atom == self.atoms["_SCREENSAVER_STATUS"]:
+            self._status_notify()
+
+    def _response_arrived(self, response: str):
+        """xscreensaver set _SCREENSAVER_RESPONSE, hold on to it for _poll_response()"""
+        # FIXME: Can there be multiple responses all at once? Should we wait the whole second and add them all up?
+        self._response = response
+
+    def _status_notify(self):
+        """_SCREENSAVER_STATUS changed"""
+        # Don't read the new status until someone actually asks for it
+        self.status = None
+        self._status_changed = True
+
+    def _process_events(self):
+        """Handle every event that's already arrived, without blocking"""
+        while self.display.pending_events():
+            self._handle_event(self.display.next_event())
+
+    def _request_status(self):
+        """Start reading _SCREENSAVER_STATUS if it's changed since last time, pass the result to _finish_status()"""
+        # Check for PropertyNotify events without blocking, if there's been none since the last read it's still correct.
+        self._process_events()
+        if self.status is not None:
+            return None
+        return self._send_status_request()
+
+    def _send_status_request(self):
+        request, = _get_property_requests(self.display, [self.status_root], self.atoms["_SCREENSAVER_STATUS"],
+                                          Xlib.Xatom.INTEGER, long_length=2)
+        self.display.flush()
+        return request
+
+    def _read_status(self):
+        """Read _SCREENSAVER_STATUS now, whether or not it's changed since last time"""
+        return self._finish_status(self._send_status_request())
+
+    def _finish_status(self, request):
+        """Wait for a _request_status() read to finish, returning the (state, timestamp) tuple"""
+        if request is not None:
+            request.reply()
+            # Xlib gives None rather than (format, values) when the property doesn't exist at all
+            format, status = request.value or (0, ())
+            if len(status) < 2:
+                # xscreensaver hasn't started yet (or something else mangled it), so it can't be blanked
+                self.status = ("UNBLANK", 0)
+            else:
+                # Anything after the first 2 items are the hack number running on each screen, don't care about those yet
+                self.status = (self.status_names.get(status[0], "UNBLANK"), status[1])
+        return self.status
+
+    def get_status(self):
+        return self._finish_status(self._request_status())
+
+    def _request_time(self):
+        return self._request_status()
+
+    def _finish_time(self, request):
+        state, since = self._finish_status(request)
+        return Response('time', self.display.get_display_name(), True, 'screen {state} since {since}'.format(
+            state={"BLANK": "blanked", "LOCK": "locked", "UNBLANK": "non-blanked"}[state], since=time.ctime(since)),
+            {'state': state, 'since': since})
+
+    def _request_version(self):
+        if not self.xss_windows:
+            self._find_xss_windows()
+        window = self.xss_windows[0]
+        request, = _get_property_requests(self.display, [window], self.atoms["_SCREENSAVER_VERSION"],
+                                          Xlib.Xatom.STRING, long_length=64)
+        self.display.flush()
+        return window, request
+
+    def _finish_version(self, request):
+        window, request = request
+        display_name = self.display.get_display_name()
+        try:
+            request.reply()
+        except Xlib.error.BadWindow:
+            # xscreensaver must've restarted, the next command will find the new window
+            self._forget_window(window.id)
+            return Response('version', display_name, False, "xscreensaver went away")
+        format, value = request.value
+        version = value.decode('latin-1').strip('\0')
+        return Response('version', display_name, True, 'XScreenSaver {version}'.format(version=version), {'version': version})
+
+    def _request_idle_time(self, max_age: float = IDLE_TIME_MAX_AGE):
+        """Start asking the X server for the idle time if the last answer is too old, pass the result to _finish_idle_time()"""
+        if not self._has_idle_time:
+            return None
+        idle, fetched = self._idle_time
+        if fetched is not None and time.monotonic() - fetched <= max_age:
+            return None
+        request = Xlib.ext.screensaver.QueryInfo(display=self.display.display, defer=True,
+                                                 opcode=self.display.display.get_extension_major('MIT-SCREEN-SAVER'),
+                                                 drawable=self.status_root)
+        self.display.flush()
+        return request
+
+    def _finish_idle_time(self, request):
+        """Wait for a _request_idle_time() query to finish, returning the idle seconds or None if the server can't tell us"""
+        if not self._has_idle_time:
+            return None
+        now = time.monotonic()
+        if request is not None:
+            request.reply()
+            self._idle_time = (request.idle / 1000, now)
+            return self._idle_time[0]
+        idle, fetched = self._idle_time
+        # It can't have been any longer than this, but the user might have done something since
+        return idle + (now - fetched)
+
+    def get_idle_time(self, max_age: float = IDLE_TIME_MAX_AGE):
+        """
+        Seconds since the last user input according to the X server, or None if the server can't tell us.
+        Answers from the last time it was asked if that was less than max_age seconds ago.
+        """
+        return self._finish_idle_time(self._request_idle_time(max_age))
+
+
+# FIXME: Should be packaged up as its own "xscreensaver_command" library rather than imported from next to dbus-xscreensaver.py
+class XSS_pool():
+    """
+    A connection_class connection to each of one or more X displays, and combining their answers into one.
+    The status is whichever display is the most blanked, and the idle time is since the last input on any of them.
+    XSS_worker drives the connections by blocking on them, dbus-xscreensaver.py's XSS_worker from the GLib main loop.
+    """
+    # How "blanked" each state is, for deciding which display's state to report
+    state_order = ("UNBLANK", "BLANK", "LOCK")
+    connection_class = XSS_connection
+
+    def __init__(self, display_names=(None,), **connection_args):
+        # None is whatever $DISPLAY says
+        self.connections = [self.connection_class(display_name, **connection_args) for display_name in display_names]
+
+    def _most_blanked(self, statuses):
+        return max(statuses, key=lambda status: self.state_order.index(status[0]))
+
+    def get_status(self):
+        """
+        Returns a (state, timestamp) tuple where state is one of "BLANK", "LOCK", or "UNBLANK"
+        and timestamp is the Unix time that xscreensaver entered that state.
+        With multiple displays this is the state of whichever one is the most blanked.
+        """
+        raise NotImplementedError()
 
     def get_active(self):
-        status = self.display.screen().root.get_full_property(
-            self.display.intern_atom("_SCREENSAVER_STATUS", False), Xlib.Xatom.INTEGER).value
-        blanked = status[0]
-        # tt = status[1]  # Something to do with the time since blanked/unblanked, not implemented here yet
-        if blanked in (self.display.intern_atom("BLANK", False), self.display.intern_atom("LOCK", False)):
-            return True
-        else:
-            return False
+        """Whether xscreensaver is blanked on any display"""
+        state, since = self.get_status()
+        return state != "UNBLANK"
+
+    def get_active_time(self):
+        """Seconds since xscreensaver blanked, or 0 if it isn't blanked"""
+        state, since = self.get_status()
+        if state == "UNBLANK":
+            return 0
+        return max(0, time.time() - since)
+
+    def get_idle_time(self, max_age: float = IDLE_TIME_MAX_AGE):
+        """
+        Seconds since the last user input on any display according to the X servers, or None if none of the servers can tell us.
+        Answers from the last time it was asked if that was less than max_age seconds ago.
+        """
+        requests = [connection._request_idle_time(max_age) for connection in self.connections]
+        idle_times = [connection._finish_idle_time(request) for connection, request in zip(self.connections, requests)]
+        idle_times = [idle for idle in idle_times if idle is not None]
+        return min(idle_times) if idle_times else None
+
+
+class XSS_worker(XSS_pool):
+    """
+    Controls xscreensaver on one or more X displays through a pool of XSS_connections, blocking until each command is answered.
+    Commands go to every display, and the status is whichever display is the most blanked.
+    """
+    def __init__(self, response_timeout: float = 1, display_names=(None,)):
+        # If there hasn't been a response in 1 second, there won't be one
+        self.response_timeout = response_timeout
+        super().__init__(display_names)
+
+    def _send_command(self, atom_name, timeout: float = None, argument: int = 0):
+        """Send a command to xscreensaver on every display, returning a list of their responses in the same order as self.connections"""
+        deadline = time.monotonic() + (self.response_timeout if timeout is None else timeout)
+        # Send to all of them before waiting for any, so it only takes as long as the slowest display rather than all of them added up
+        waiting = {connection: (connection._start_command(atom_name, argument), 0) for connection in self.connections}
+        responses = {}
+        while True:
+            for connection, (bad_window, attempt) in list(waiting.items()):
+                try:
+                    # FIXME: Does every command send a response?
+                    #        Should I leave this part for the parent function?
+                    response = connection._poll_response(bad_window)
+                except _XSSWindowGone:
+                    # If xscreensaver has restarted since we found its window, use another one or find the new window and try once more
+                    if attempt >= 1:
+                        raise NoScreensaverError("xscreensaver window keeps disappearing on {display}. Is xscreensaver restarting?".format(
+                            display=connection.display.get_display_name()))
+                    waiting[connection] = (connection._start_command(atom_name, argument), attempt + 1)
+                    continue
+                if response is not None:
+                    responses[connection] = response
+                    del waiting[connection]
+            if not waiting:
+                return [responses[connection] for connection in self.connections]
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise XSSTimeoutError("No response received from xscreensaver on {displays}".format(
+                    displays=', '.join(connection.display.get_display_name() for connection in waiting)))
+            # Block on the X connections themselves rather than spinning on pending_events()
+            select.select(list(waiting), [], [], remaining)
+
+    def _command(self, verb, argument: int = 0):
+        """Send a command to xscreensaver on every display, returning a Response from each of them"""
+        return [Response.parse(verb, connection.display.get_display_name(), response)
+                for connection, response in zip(self.connections, self._send_command(verb.upper(), argument=argument))]
+
+    def get_status(self):
+        # Only the displays whose status changed since last time need asking, and they all get asked at once
+        requests = [connection._request_status() for connection in self.connections]
+        return self._most_blanked([connection._finish_status(request) for connection, request in zip(self.connections, requests)])
+
+    def watch(self):
+        """
+        Generator that yields a (state, timestamp) tuple, like get_status(), every time xscreensaver blanks, locks, or unblanks.
+        This is the equivalent of xscreensaver-command -watch, except that it sleeps on the X connections between changes.
+        """
+        # Like xscreensaver-command, don't report the state it was already in when we started watching.
+        last_state, since = self.get_status()
+        for connection in self.connections:
+            connection._status_changed = False
+        while True:
+            for connection in self.connections:
+                connection._process_events()
+            if not any(connection._status_changed for connection in self.connections):
+                select.select(self.connections, [], [])
+                continue
+
+            for connection in self.connections:
+                connection._status_changed = False
+            # _SCREENSAVER_STATUS also changes when xscreensaver switches to another hack, ignore those
+            state, since = self.get_status()
+            if state != last_state:
+                last_state = state
+                yield state, since
 
     def activate(self):
         """
@@ -94,9 +565,7 @@ class XSS_worker():
         if the user had been idle for long enough.) The screensaver will
         deactivate as soon as there is any user activity, as usual.
         """
-        response = self._send_command("ACTIVATE")
-        assert response in ('activating.', 'already active.')
-        return response
+        return self._command("activate")
 
     def deactivate(self):
         """
@@ -109,9 +578,7 @@ class XSS_worker():
         countdown (so, issuing the -deactivate command periodically is one way
         to prevent the screen from blanking.)
         """
-        response = self._send_command("DEACTIVATE")
-        assert response in ('deactivating.', 'not active: idle timer reset.')
-        return response
+        return self._command("deactivate")
 
     def lock(self):
         """
@@ -120,6 +587,168 @@ class XSS_worker():
         not the default (that is, even if xscreensaver's lock resource is
         false, and even if the lockTimeout resource is non-zero.)
         """
-        response = self._send_command("LOCK")
-        assert response in ('activating and locking.', 'locking.', 'already locked.')
-        return response
+        return self._command("lock")
+
+    def cycle(self):
+        """
+        If the screensaver is active (the screen is blanked), then stop the
+        current graphics demo and run a new one (chosen randomly.)
+        """
+        return self._command("cycle")
+
+    def next(self):
+        """
+        This is like either -activate or -cycle, depending on which is more
+        appropriate, except that the graphics hack that will be run is the next
+        one in the list, instead of a randomly-chosen one.
+        """
+        return self._command("next")
+
+    def prev(self):
+        """This is like -next, but cycles in the other direction."""
+        return self._command("prev")
+
+    def select(self, number: int):
+        """Like -activate, but runs the Nth element in the list of hacks."""
+        return self._command("select", argument=number)
+
+    def restart(self):
+        """
+        Causes the screensaver process to exit and then restart with the same
+        command line arguments as last time.
+        """
+        return self._command("restart")
+
+    def exit(self):
+        """
+        Causes the xscreensaver process to exit gracefully.
+        This does nothing if the display is currently locked.
+        """
+        return self._command("exit")
+
+    def time(self):
+        """When each display's xscreensaver last blanked, locked, or unblanked"""
+        return list(self.run([('time',)]))
+
+    def version(self):
+        """Which version of xscreensaver each display is running"""
+        return list(self.run([('version',)]))
+
+    def run(self, commands):
+        """
+        Run each of commands, like [('select', 3), ('time',)], in order, yielding a Response from each display for each command.
+        Everything goes over the same connections, and runs of "time" & "version" have all their requests sent before waiting for any replies.
+        """
+        # NOTE: The xscreensaver commands themselves can't be pipelined like that,
+        #       there's only the one _SCREENSAVER_RESPONSE property so xscreensaver can only answer one at a time.
+        commands = list(commands)
+        while commands:
+            reads = []
+            while commands and commands[0][0] in READ_VERBS:
+                reads.append(commands.pop(0)[0])
+            if not reads:
+                verb, *arguments = commands.pop(0)
+                yield from getattr(self, verb)(*arguments)
+                continue
+
+            requests = [[getattr(connection, '_request_' + verb)() for connection in self.connections] for verb in reads]
+            for verb, verb_requests in zip(reads, requests):
+                for connection, request in zip(self.connections, verb_requests):
+                    yield getattr(connection, '_finish_' + verb)(request)
+
+
+def parse_commands(words):
+    """Turn command line words like ['select', '3', 'time'] into commands for XSS_worker.run() like [('select', 3), ('time',)]"""
+    commands = []
+    words = iter(words)
+    for verb in words:
+        if verb not in VERBS:
+            raise ValueError("Unknown command {verb!r}".format(verb=verb))
+        try:
+            arguments = [int(next(words)) for _ in range(VERBS[verb])]
+        except (StopIteration, ValueError):
+            raise ValueError("{verb} needs {count} number(s)".format(verb=verb, count=VERBS[verb]))
+        # They go in a ClientMessage as unsigned 32-bit numbers, and xscreensaver counts hacks from 1
+        if any(not 1 <= argument < 2**32 for argument in arguments):
+            raise ValueError("{verb} needs a number from 1 upwards".format(verb=verb))
+        commands.append((verb, *arguments))
+    return commands
+
+
+def print_error(error, json_output: bool = False):
+    """Report not being able to talk to xscreensaver at all, the same way whichever command ran into it"""
+    if json_output:
+        print(json.dumps({'ok': False, 'message': str(error)}), flush=True)
+    else:
+        print(error, file=sys.stderr, flush=True)
+
+
+def print_responses(worker, commands, json_output: bool = False):
+    """Run commands and print each response as soon as it arrives, returning whether they all succeeded"""
+    all_ok = True
+    try:
+        for response in worker.run(commands):
+            all_ok = all_ok and response.ok
+            if json_output:
+                print(json.dumps(response.as_dict()), flush=True)
+            elif len(worker.connections) > 1:
+                print(response.display, response, file=sys.stdout if response.ok else sys.stderr, flush=True)
+            else:
+                print(response, file=sys.stdout if response.ok else sys.stderr, flush=True)
+    except (XSSTimeoutError, NoScreensaverError, Xlib.error.DisplayConnectionError) as e:
+        print_error(e, json_output)
+        return False
+    return all_ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Control a running xscreensaver",
+        epilog="batch runs every command given after it, or one line of commands at a time from stdin, over the same X connection.")
+    parser.add_argument('--display', '-d', action='append', dest='displays',
+                        help="X display to control, can be given multiple times (default: $DISPLAY)")
+    parser.add_argument('--json', action='store_true', help="Print each response as a line of JSON")
+    parser.add_argument('command', choices=tuple(VERBS) + ('watch', 'batch'))
+    parser.add_argument('arguments', nargs='*', help="The number for select, or the commands for batch")
+    args = parser.parse_args()
+
+    # Check the command line before paying for the X connection
+    try:
+        if args.command == 'batch':
+            commands = parse_commands(args.arguments)
+        elif args.command != 'watch':
+            commands = parse_commands([args.command] + args.arguments)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Needed for the except below, even if connecting is what fails
+    _load_xlib()
+    try:
+        worker = XSS_worker(display_names=args.displays or (None,))
+        if args.command == 'watch':
+            try:
+                for state, since in worker.watch():
+                    if args.json:
+                        print(json.dumps({'state': state, 'since': since}), flush=True)
+                    else:
+                        print(state, time.ctime(since), flush=True)
+            except KeyboardInterrupt:
+                pass
+            sys.exit(0)
+    except (XSSTimeoutError, NoScreensaverError, Xlib.error.DisplayConnectionError) as e:
+        print_error(e, args.json)
+        sys.exit(1)
+
+    if args.command == 'batch' and not commands:
+        all_ok = True
+        for line in sys.stdin:
+            try:
+                commands = parse_commands(line.split())
+            except ValueError as e:
+                print(e, file=sys.stderr, flush=True)
+                all_ok = False
+                continue
+            all_ok = print_responses(worker, commands, args.json) and all_ok
+        sys.exit(0 if all_ok else 1)
+    else:
+        sys.exit(0 if print_responses(worker, commands, args.json) else 1)